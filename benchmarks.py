@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+# micro-benchmarks of the hot paths, on the shipped corpora (data/*.txt) and models (data/models/*)
+#
+#   python benchmarks.py run [-o benchmarks.json]           time all the benchmarks, write the baseline
+#   python benchmarks.py compare [-o benchmarks.json]       time again, flag regressions over the baseline
+#
+# -k selects the benchmarks whose name contains the given string
+
+import json
+import optparse
+import platform
+import random
+import sys
+import time
+from datetime import datetime
+import numpy as np
+from deap import base, creator
+import compression
+import markov
+import metrics
+import novelty_search
+import sbc
+import utils
+
+# corpora (name, separator), smaller first
+CORPORA = [("input", ""), ("irish", " "), ("all_irish-notes_and_durations-abc", " ")]
+MODELS = ["input", "all_irish-notes_and_durations-abc", "all_songs_in_G"]
+
+
+def _individuals(alphabet, n, length, seed=0):
+    rnd = random.Random(seed)
+    return [rnd.choices(alphabet, k=length) for _ in range(n)]
+
+
+def _markov_trans(name, sep, fun):
+    seqs = utils.read_from_file("data/" + name + ".txt", separator=sep)[0]
+    return lambda: fun(seqs)
+
+
+def _load_model(name, compact):
+    return lambda: markov.load_model("data/models/" + name, compact=compact)
+
+
+def _support_log(name, compact, length):
+    tps, alphabet = markov.load_model("data/models/" + name, compact=compact)
+    pop = _individuals(alphabet, 50, length)
+
+    def run():
+        for ind in pop:
+            markov.sequences_markov_support_log(ind, tps)
+    return run
+
+
+def _generate(name, occ_per_seq):
+    tps, _alphabet = markov.load_model("data/models/" + name, compact=False)
+    weights = [0.1, 0.2, 0.3, 0.2, 0.1, 0.1, 0.0][:len(tps)]
+
+    def run():
+        random.seed(0)
+        markov.generate_with_weights(tps, weights, n_seq=20, occ_per_seq=occ_per_seq)
+    return run
+
+
+def _chunks_detection(name, sep):
+    seqs = utils.read_from_file("data/" + name + ".txt", separator=sep)[0]
+    tf = markov.markov_trans_freq(seqs)
+    chunks = markov.chunk_sequences(seqs, markov.detect_transitions(seqs, tf, numeric=True), 0.85,
+                                    orders=[1, 2, 3, 4, 5])
+    return lambda: markov.chunks_detection(seqs, chunks)
+
+
+def _novelty(n_pop, n_arch):
+    # the individuals of the novelty tournaments (as in main.run_ga)
+    if not hasattr(creator, "FitnessMaxTN"):
+        creator.create("FitnessMaxTN", base.Fitness, weights=(-1.0,))
+        creator.create("IndividualTN", list, fitness=creator.FitnessMaxTN)
+    _tps, alphabet = markov.load_model("data/models/input", compact=False)
+    pop = _individuals(alphabet, n_pop, 50, seed=1)
+    archive = _individuals(alphabet, n_arch, 50, seed=2)
+
+    def run():
+        random.seed(0)
+        for ind in pop:
+            novelty_search.novelty(ind, pop, archive)
+    return run
+
+
+def _novelty_population(n_pop, n_arch):
+    _tps, alphabet = markov.load_model("data/models/input", compact=False)
+    pop = _individuals(alphabet, n_pop, 50, seed=1)
+    archive = _individuals(alphabet, n_arch, 50, seed=2)
+    return lambda: novelty_search.novelty_population(pop, pop, archive)
+
+
+def _archive_dissim(n_arch):
+    _tps, alphabet = markov.load_model("data/models/input", compact=False)
+    individuals = _individuals(alphabet, 20, 50, seed=1)
+    archive = _individuals(alphabet, n_arch, 50, seed=2)
+
+    def run():
+        for ind in individuals:
+            novelty_search.archive_dissim(ind, archive, dissimil_fun=metrics.str_dissimilarity)
+    return run
+
+
+def _sbc(n):
+    data = sbc.read_lines("data/all_songs_in_G.txt")[:n]
+    # a new compressed sizes cache at each call: every string is compressed
+    return lambda: sbc.SBC("bz2", "9", data, cache=compression.CompressedSizeCache()).compute()
+
+
+# name -> setup function, returning the function to time
+BENCHMARKS = dict()
+for _name, _sep in CORPORA:
+    BENCHMARKS["markov_trans_occ[" + _name + "]"] = (_markov_trans, _name, _sep, markov.markov_trans_occ)
+    BENCHMARKS["markov_trans_freq[" + _name + "]"] = (_markov_trans, _name, _sep, markov.markov_trans_freq)
+for _name in MODELS:
+    BENCHMARKS["load_model[" + _name + ",dict]"] = (_load_model, _name, False)
+    BENCHMARKS["load_model[" + _name + ",compact]"] = (_load_model, _name, True)
+for _name in MODELS[:2]:
+    for _length in (50, 200):
+        BENCHMARKS["sequences_markov_support_log[%s,dict,50x%d]" % (_name, _length)] = \
+            (_support_log, _name, False, _length)
+        BENCHMARKS["sequences_markov_support_log[%s,compact,50x%d]" % (_name, _length)] = \
+            (_support_log, _name, True, _length)
+    for _occ in (100, 1000):
+        BENCHMARKS["generate_with_weights[%s,20x%d]" % (_name, _occ)] = (_generate, _name, _occ)
+for _name, _sep in CORPORA:
+    BENCHMARKS["chunks_detection[" + _name + "]"] = (_chunks_detection, _name, _sep)
+for _n_arch in (50, 500):
+    BENCHMARKS["novelty[pop=50,archive=%d]" % _n_arch] = (_novelty, 50, _n_arch)
+    BENCHMARKS["novelty_population[pop=50,archive=%d]" % _n_arch] = (_novelty_population, 50, _n_arch)
+    BENCHMARKS["archive_dissim[20,archive=%d]" % _n_arch] = (_archive_dissim, _n_arch)
+for _n in (20, 60, 150):
+    BENCHMARKS["SBC.compute[all_songs_in_G,%d]" % _n] = (_sbc, _n)
+
+
+def timeit(fun, repeat=5, min_time=0.05):
+    """Best time of one call: fun is called in loops lasting at least min_time, repeat times"""
+    number = 1
+    while True:
+        t = time.perf_counter()
+        for _ in range(number):
+            fun()
+        elapsed = time.perf_counter() - t
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed <= 0 else max(2, int(min_time / elapsed) + 1)
+    best = elapsed / number
+    for _ in range(repeat - 1):
+        t = time.perf_counter()
+        for _ in range(number):
+            fun()
+        best = min(best, (time.perf_counter() - t) / number)
+    return {"seconds": best, "number": number, "repeat": repeat}
+
+
+def run_all(selected=None, repeat=5, min_time=0.05):
+    """Time the benchmarks (whose name contains selected) and return the results"""
+    results = dict()
+    for name, (setup, *args) in BENCHMARKS.items():
+        if selected and selected not in name:
+            continue
+        results[name] = timeit(setup(*args), repeat, min_time)
+        print("%-80s %12.6f s" % (name, results[name]["seconds"]))
+        sys.stdout.flush()
+    return {"meta": {"date": datetime.now().isoformat(timespec="seconds"), "python": platform.python_version(),
+                     "numpy": np.__version__, "machine": platform.machine(), "node": platform.node()},
+            "results": results}
+
+
+def compare(baseline, current, threshold=0.2):
+    """Print the ratios current / baseline, return the names of the benchmarks slower than 1 + threshold"""
+    regressions = []
+    for name, res in current["results"].items():
+        if name not in baseline["results"]:
+            print("%-80s %12.6f s   (new)" % (name, res["seconds"]))
+            continue
+        ratio = res["seconds"] / baseline["results"][name]["seconds"]
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        elif ratio < 1 / (1 + threshold):
+            flag = "  faster"
+        print("%-80s %12.6f s %7.2fx%s" % (name, res["seconds"], ratio, flag))
+    return regressions
+
+
+def main():
+    opt = optparse.OptionParser("usage: %prog run|compare [OPTION]")
+    opt.add_option('-o', dest='baseline', default='benchmarks.json', help='baseline file')
+    opt.add_option('-k', dest='selected', default=None, help='run the benchmarks whose name contains this')
+    opt.add_option('-r', dest='repeat', default=5, type='int', help='number of timed repeats')
+    opt.add_option('-m', dest='min_time', default=0.05, type='float', help='min seconds of each timed repeat')
+    opt.add_option('-t', dest='threshold', default=0.2, type='float', help='regression threshold (0.2 = 20%)')
+    (options, args) = opt.parse_args()
+    if not args or args[0] not in ("run", "compare"):
+        opt.error("run or compare")
+
+    if args[0] == "run":
+        res = run_all(options.selected, options.repeat, options.min_time)
+        with open(options.baseline, "w") as fp:
+            json.dump(res, fp, indent=1)
+        print("baseline written to", options.baseline)
+    else:
+        with open(options.baseline) as fp:
+            baseline = json.load(fp)
+        print("baseline:", baseline["meta"])
+        res = run_all(options.selected, options.repeat, options.min_time)
+        print()
+        regressions = compare(baseline, res, options.threshold)
+        if regressions:
+            print(len(regressions), "regression(s) over", str(int(options.threshold * 100)) + "%:", ", ".join(regressions))
+            sys.exit(1)
+        print("no regressions over", str(int(options.threshold * 100)) + "%")
+
+
+if __name__ == '__main__':
+    main()
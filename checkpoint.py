@@ -0,0 +1,17 @@
+import os
+import pickle
+
+
+def save(path, state):
+    """Write the state (pickled) atomically: to a temporary file, then renamed over path"""
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as fp:
+        pickle.dump(state, fp, protocol=pickle.HIGHEST_PROTOCOL)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp, path)
+
+
+def load(path):
+    with open(path, "rb") as fp:
+        return pickle.load(fp)
@@ -0,0 +1,56 @@
+import bz2
+import hashlib
+import zlib
+from collections import OrderedDict
+
+# default compression level of each compressor
+DEFAULT_LEVEL = {"bz2": 9, "zlib": -1}
+
+
+def compress(data, compressor="bz2", level=None):
+    if isinstance(data, str):
+        data = data.encode()
+    if level is None:
+        level = DEFAULT_LEVEL[compressor]
+    if compressor == "bz2":
+        return bz2.compress(data, int(level))
+    if compressor == "zlib":
+        return zlib.compress(data, int(level))
+    raise ValueError("invalid compressor: " + str(compressor))
+
+
+# bounded LRU memo of compressed sizes, keyed by (compressor, level, content hash)
+class CompressedSizeCache(object):
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.sizes = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def size(self, data, compressor="bz2", level=None):
+        """Return len(compress(data)), compressing each distinct content once"""
+        if isinstance(data, str):
+            data = data.encode()
+        if level is None:
+            level = DEFAULT_LEVEL[compressor]
+        key = (compressor, int(level), hashlib.blake2b(data, digest_size=16).digest())
+        if key in self.sizes:
+            self.sizes.move_to_end(key)
+            self.hits += 1
+            return self.sizes[key]
+        self.misses += 1
+        res = len(compress(data, compressor, level))
+        self.sizes[key] = res
+        while len(self.sizes) > self.maxsize:
+            self.sizes.popitem(last=False)
+        return res
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"size": len(self.sizes), "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
+# cache shared by metrics.compute_ncd and sbc.SBC
+SIZE_CACHE = CompressedSizeCache()
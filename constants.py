@@ -7,12 +7,31 @@ POP_SIZE = 50  # population size
 N_ELITE = 5
 # novelty search
 MAX_ARCH = 5
+ARCH_CAPACITY = 5000  # max number of archive entries (assessments scan the whole archive), 0 = unbounded
+ARCH_POLICY = "oldest"  # archive eviction: oldest, least_novel or lowest_fitness
 NOV_FIT_THRESH = 455 #0.75
 NOV_ARCH_MIN_DISS = 0.5  # for archive assessment
 NOV_T_MIN = 35  # min number of feasible individuals
 NOV_T_MAX = 45  # max number of feasible individuals
+NOV_NEIGHBOURS = "knn"  # novelty neighbours: knn (k nearest) or tournament (tournaments + best of archive)
 CXPB = 0.5  # crossover probability
 MUTPB = 0.35  # mutation probability
+# island model (islands.py)
+ISLANDS = 4  # number of islands (processes), each of POP_SIZE individuals
+MIGRATION_GENS = 5  # generations between migrations, 0 = never
+MIGRANTS = 2  # individuals sent to each destination island
+MIGRATION_TOPOLOGY = "ring"  # ring (to the next island) or full (to all the others)
+MIGRATION_CRITERION = "best"  # emigrants: best (fitness) or novel (novelty)
+MIGRATION_TIMEOUT = 600  # max seconds waiting for the migrants of another island
+# evaluation
+FIT_CACHE_SIZE = 0  # max entries of the fitness memo (LRU), 0 = disabled
+EVAL_MODE = "serial"  # fitness executor: serial, thread or process
+EVAL_WORKERS = 1  # number of threads/processes of the executor
+# output
+STATS_JSON = True  # also write stats.json (rebuilt from run_log.jsonl) at the end of a run
+CHECKPOINT_GENS = 0  # write checkpoint.pkl every n generations, 0 = never
+CHECKPOINT_SECS = 0  # write checkpoint.pkl every n seconds, 0 = never
+PROFILE = False  # time the phases of each generation (in run_log.jsonl and a summary at the end)
 
 
 
@@ -1,9 +1,15 @@
 import random
+from collections import OrderedDict
 
 import constants
 import numpy as np
 import novelty_search
 import markov
+from ngram_trie import NgramTrie
+from phase_timer import PhaseTimer
+
+# timer of the calls without one
+_NO_TIMER = PhaseTimer(enabled=False)
 
 
 # fun for creating an individual
@@ -13,27 +19,179 @@ def create_individual(alphabet):
     return v
 
 
+# bounded LRU memo of fitness values, keyed by (model fingerprint, genome)
+class FitnessCache(object):
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.values = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # last model seen and its fingerprint (computed once per model)
+        self._model = None
+        self._fingerprint = None
+
+    def __getstate__(self):
+        # the model is not saved with the cache (checkpoints): the keys do not depend on it
+        state = self.__dict__.copy()
+        state["_model"] = None
+        state["_fingerprint"] = None
+        return state
+
+    def key(self, individual, tps):
+        if tps is not self._model:
+            self._model = tps
+            self._fingerprint = markov.model_fingerprint(tps)
+        return self._fingerprint, tuple(individual)
+
+    def get(self, key):
+        """Return the cached fitness (and mark it as recently used), None on a miss"""
+        if key in self.values:
+            self.values.move_to_end(key)
+            self.hits += 1
+            return self.values[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        self.values[key] = value
+        self.values.move_to_end(key)
+        while len(self.values) > self.maxsize:
+            # evict the least recently used
+            self.values.popitem(last=False)
+
+    def stats(self):
+        return {"maxsize": self.maxsize, "size": len(self.values), "hits": self.hits, "misses": self.misses}
+
+
 # fun for evaluating individuals
-def eval_fitness(individual, tps):
+def eval_fitness(individual, tps, cache=None):
     """
     Generates NUM_SEQS sequences with given tps-model and evaluate each sequences with given classes and patterns.
     Return percentage of hits.
     """
+    if cache is not None:
+        key = cache.key(individual, tps)
+        res = cache.get(key)
+        if res is not None:
+            return res
     # use similarity instead of perfect match
     # res = fc.evaluate_sequences2(sequences, classes["fc"], patterns)
     res = markov.sequences_markov_support_log(individual, tps)
+    if cache is not None:
+        cache.put(key, res)
 
     return res
 
 
-# on genotype
-def eval_fitness_and_novelty(individual, tps, population, archive):
-    fit = eval_fitness(individual, tps)
+# on genotype (the novelty is never cached: it depends on population and archive)
+def eval_fitness_and_novelty(individual, tps, population, archive, cache=None):
+    fit = eval_fitness(individual, tps, cache=cache)
     novelty_search.archive_assessment(individual, fit, archive)
     nov = novelty_search.novelty(individual, population, archive)
     return fit, nov
 
 
+# fun for evaluating a list of individuals at once (same values as eval_fitness)
+def eval_fitness_population(individuals, tps, cache=None, fitness_fun=markov.population_markov_support_log):
+    if cache is None:
+        return fitness_fun(individuals, tps)
+    return _eval_with_cache(individuals, tps, cache, fitness_fun)
+
+
+# look up individuals in cache, score the misses together with fitness_fun (repeated genomes once)
+def _eval_with_cache(individuals, tps, cache, fitness_fun):
+    res = []
+    keys = []
+    todo = OrderedDict()
+    for individual in individuals:
+        key = cache.key(individual, tps)
+        keys.append(key)
+        if key in todo:
+            cache.hits += 1
+            res.append(None)
+        else:
+            res.append(cache.get(key))
+            if res[-1] is None:
+                todo[key] = len(res) - 1
+    if todo:
+        fits = dict(zip(todo.keys(), fitness_fun([individuals[i] for i in todo.values()], tps)))
+        for key, fit in fits.items():
+            cache.put(key, fit)
+        for i, key in enumerate(keys):
+            if res[i] is None:
+                res[i] = fits[key]
+    return res
+
+
+# fun for evaluating individuals that carry their per-position fitness terms (after crossover and mutation)
+def eval_fitness_population_incremental(individuals, tps, cache=None):
+    """
+    Same values as eval_fitness_population. Each individual keeps the symbol ids it was scored on
+    (individual.scored_ids) and the per-position terms of its fitness (individual.fitness_terms),
+    which survive toolbox.clone. A term depends on the last max_order symbols only, so just the
+    positions within max_order after a changed symbol are scored again.
+    """
+    if cache is not None:
+        return _eval_with_cache(individuals, tps, cache, eval_fitness_population_incremental)
+    if not isinstance(tps, NgramTrie) or len(individuals) == 0 or len(set(len(x) for x in individuals)) > 1:
+        return eval_fitness_population(individuals, tps)
+    ids = tps.encode_matrix(individuals)
+    if ids.shape[1] == 0:
+        return [0] * len(individuals)
+    terms = np.zeros(ids.shape, dtype=np.float64)
+    todo = np.ones(ids.shape, dtype=bool)
+    for r, individual in enumerate(individuals):
+        scored = getattr(individual, "scored_ids", None)
+        if scored is not None and len(scored) == ids.shape[1]:
+            terms[r] = individual.fitness_terms
+            changed = ids[r] != scored
+            # positions whose window touches a changed symbol
+            todo[r] = changed
+            for shift in range(1, tps.max_order + 1):
+                todo[r, shift:] |= changed[:-shift]
+    rows, cols = np.nonzero(todo)
+    terms[rows, cols] = markov.markov_support_log_terms(ids, tps, rows, cols)
+    for r, individual in enumerate(individuals):
+        individual.scored_ids = ids[r].copy()
+        individual.fitness_terms = terms[r].copy()
+    # cumsum adds left to right, as sequences_markov_support_log
+    return np.cumsum(terms, axis=1)[:, -1].tolist()
+
+
+# as eval_fitness_and_novelty for each individual, in order (the archive grows along the list):
+# archive assessments first, then the novelty of all the individuals in one pass
+def eval_fitness_and_novelty_population(individuals, tps, population, archive,
+                                        fitness_fun=eval_fitness_population, cache=None,
+                                        neighbours=None, timer=None):
+    neighbours = neighbours if neighbours is not None else constants.NOV_NEIGHBOURS
+    timer = timer if timer is not None else _NO_TIMER
+    with timer.phase("fitness"):
+        fits = fitness_fun(individuals, tps, cache=cache)
+    with timer.phase("archive_assessment"):
+        # all the entries of the archive during the pass (evicted ones too), in order of admission:
+        # individual i sees the first lengths[i] of them, except those removed (evicted) at or before i
+        seen = list(archive)
+        # position in seen of each entry of the archive
+        current = list(range(len(seen)))
+        removed = [-1] * len(seen)
+        lengths = []
+        for i, (individual, fit) in enumerate(zip(individuals, fits)):
+            evictions = getattr(archive, "evictions", 0)
+            novelty_search.archive_assessment(individual, fit, archive)
+            if getattr(archive, "evictions", 0) > evictions:
+                removed[current.pop(archive.last_evicted)] = i
+            if len(archive) > len(current):
+                current.append(len(seen))
+                seen.append(archive[-1])
+                removed.append(-1)
+            lengths.append(len(seen))
+    with timer.phase("novelty"):
+        novs = novelty_search.novelty_population(individuals, population, seen, method=neighbours,
+                                                 archive_lengths=lengths, archive_removed=removed)
+    return list(zip(fits, novs))
+
+
 # decorator to normalize individuals
 def normalize_individuals():
     def decorator(func):
@@ -0,0 +1,116 @@
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
+import deap_ops
+
+# model of a process worker, sent once by the pool initializer
+_worker_tps = None
+
+
+def _init_worker(tps):
+    global _worker_tps
+    _worker_tps = tps
+
+
+# a genome carrying its incremental scoring state, as the individuals do
+class _Genome(list):
+    pass
+
+
+# process worker: score a chunk of (genome, scored_ids, fitness_terms)
+def _score_chunk(chunk):
+    genomes = []
+    for genome, scored_ids, terms in chunk:
+        g = _Genome(genome)
+        if scored_ids is not None:
+            g.scored_ids = scored_ids
+            g.fitness_terms = terms
+        genomes.append(g)
+    fits = deap_ops.eval_fitness_population_incremental(genomes, _worker_tps)
+    return fits, [(getattr(g, "scored_ids", None), getattr(g, "fitness_terms", None)) for g in genomes]
+
+
+# split a list in n contiguous chunks of (almost) the same size
+def split_chunks(lst, n):
+    n = max(1, min(n, len(lst)))
+    size, rest = divmod(len(lst), n)
+    chunks = []
+    start = 0
+    for i in range(n):
+        end = start + size + (1 if i < rest else 0)
+        chunks.append(lst[start:end])
+        start = end
+    return chunks
+
+
+# pluggable executor for the evaluation of individuals
+class Evaluator(object):
+    """
+    Evaluates the fitness of lists of individuals serially, on a thread pool or on a process pool.
+    Individuals are split in contiguous chunks and results are collected in order, so values do
+    not depend on the number of workers. Process workers receive the model once, at startup.
+
+    ...
+
+    Parameters
+    ----------
+    tps : NgramTrie or dict
+        the transitional probabilities model
+    mode : str
+        "serial", "thread" or "process"
+    workers : int
+        number of threads/processes
+    """
+
+    def __init__(self, tps, mode="serial", workers=1):
+        self.tps = tps
+        self.mode = mode
+        self.workers = max(1, workers)
+        self.pool = None
+        if mode == "thread":
+            self.pool = ThreadPoolExecutor(self.workers)
+        elif mode == "process":
+            self.pool = mp.Pool(self.workers, initializer=_init_worker, initargs=(tps,))
+        elif mode != "serial":
+            raise ValueError("invalid evaluation mode: " + str(mode))
+
+    def map(self, fun, iterable):
+        """Ordered map on the executor (to be registered as toolbox.map)"""
+        if self.mode == "thread":
+            return list(self.pool.map(fun, iterable))
+        if self.mode == "process":
+            return self.pool.map(fun, iterable)
+        return list(map(fun, iterable))
+
+    def fitness(self, individuals, tps=None):
+        """
+        Fitness of each individual, same values as deap_ops.eval_fitness_population_incremental.
+        The model is the one of the executor (given at startup to the process workers): tps, if given,
+        must be that model.
+        """
+        if tps is not None and tps is not self.tps:
+            raise ValueError("Evaluator.fitness: tps is not the model of the executor")
+        if self.mode == "serial" or len(individuals) < 2:
+            return deap_ops.eval_fitness_population_incremental(individuals, self.tps)
+        chunks = split_chunks(individuals, self.workers)
+        if self.mode == "thread":
+            # threads share the individuals: their scoring state is updated in place
+            res = self.map(lambda c: deap_ops.eval_fitness_population_incremental(c, self.tps), chunks)
+            return [f for fits in res for f in fits]
+        payloads = [[(list(x), getattr(x, "scored_ids", None), getattr(x, "fitness_terms", None)) for x in c]
+                    for c in chunks]
+        fits = []
+        for chunk, (chunk_fits, states) in zip(chunks, self.map(_score_chunk, payloads)):
+            fits.extend(chunk_fits)
+            for individual, (scored_ids, terms) in zip(chunk, states):
+                if scored_ids is not None:
+                    individual.scored_ids = scored_ids
+                    individual.fitness_terms = terms
+        return fits
+
+    def close(self):
+        if self.mode == "thread":
+            self.pool.shutdown()
+        elif self.mode == "process":
+            self.pool.close()
+            self.pool.join()
+        self.pool = None
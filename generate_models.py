@@ -2,9 +2,21 @@ import json
 from datetime import datetime
 import os
 import random
+import resource
+import sys
 import utils
 import markov
 
+# corpora in data/ and their tokens separator
+CORPORA = [
+    {"name": "input", "sep": ""},
+    {"name": "input2", "sep": ""},
+    {"name": "irish", "sep": " "},
+    {"name": "bicinia", "sep": " "},
+    {"name": "all_irish-notes_and_durations-abc", "sep": " "},
+    {"name": "all_songs_in_G", "sep": ""},
+]
+
 
 def create(file_name, file_in_sep):
     """Generate tps from sequences in file_in"""
@@ -17,18 +29,61 @@ def create(file_name, file_in_sep):
     else:
         print("Directory ", dir_out, "already exists")
 
-    # calculate model and form classes
+    # calculate model and form classes (streaming the corpus: it is never loaded all together)
     ti = datetime.now()
-    sequences, voc = utils.read_from_file("data/" + file_name + ".txt", separator=file_in_sep)
-    os.mkdir(dir_out + "model/")
+    os.makedirs(dir_out + "model/", exist_ok=True)
+    tf, voc, n_tokens = markov.compute_streaming(
+        lambda: utils.iter_sequences("data/" + file_name + ".txt", separator=file_in_sep),
+        dir_name=dir_out + "model/")
     with open(dir_out + "model/alphabet.json", "w") as fp:
         json.dump(voc, fp)
-    markov.compute(sequences, dir_name=dir_out + "model/")
-    print("Model of " + file_name + " computed... time: ", (datetime.now() - ti).total_seconds(), "s.")
+    markov.save_model_binary(tf, voc, dir_out + "model/")
+    secs = (datetime.now() - ti).total_seconds()
+    print("Model of " + file_name + " computed... time: ", secs, "s.")
+    print("tokens:", n_tokens, "(" + str(round(n_tokens / secs)) + " tokens/sec),",
+          "peak RSS:", round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1), "MB")
     # plots.plot_tps(dir_out, tps)
 
     return dir_out
 
 
+def model_exists(file_name):
+    """True if the model of file_name is complete (alphabet.json is written after the transitions)"""
+    dir_in = "data/models/" + file_name + "/model/"
+    return os.path.exists(dir_in + "alphabet.json") and \
+        (os.path.exists(dir_in + "tf.bin") or os.path.exists(dir_in + "tf.json"))
+
+
+def convert(file_name):
+    """Write the binary model (tf.bin) of an existing model dir from its tf.json"""
+    dir_in = "data/models/" + file_name
+    tf, alph = markov.load_model(dir_in, compact=False)
+    markov.save_model_binary(tf, alph, dir_in + "/model/")
+    print("Model of " + file_name + " converted")
+
+
+def convert_all():
+    """Write the binary model of every dir in data/models"""
+    for file_name in sorted(os.listdir("data/models/")):
+        if os.path.exists("data/models/" + file_name + "/model/tf.json"):
+            convert(file_name)
+
+
+def check_counts(corpora=CORPORA):
+    """Check the single-pass counting against the reference counting on the data/*.txt corpora"""
+    res = True
+    for fl in corpora:
+        sequences, voc = utils.read_from_file("data/" + fl["name"] + ".txt", separator=fl["sep"])
+        ok = markov.check_trans_occ(sequences)
+        print(fl["name"] + ":", "OK" if ok else "FAILED")
+        res = res and ok
+    return res
+
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "check":
+        sys.exit(0 if check_counts() else 1)
+    if len(sys.argv) > 1 and sys.argv[1] == "convert":
+        convert_all()
+        sys.exit(0)
     create("input2", "")
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+
+# island model: K GAs (main.run_ga) in separate processes, each with its own population and archive,
+# exchanging individuals every MIGRATION_GENS generations
+#
+#   python islands.py [FILE_IN] [SEED] [METHOD]
+
+import multiprocessing as mp
+import os
+import queue
+import sys
+from datetime import datetime
+import constants
+import main
+import run_log
+
+
+# islands sending their emigrants to island i, and receiving the emigrants of island i
+def neighbours(i, n_islands, topology):
+    if n_islands < 2:
+        return [], []
+    if topology == "ring":
+        return [(i - 1) % n_islands], [(i + 1) % n_islands]
+    if topology == "full":
+        others = [j for j in range(n_islands) if j != i]
+        return others, others
+    raise ValueError("invalid migration topology: " + str(topology))
+
+
+# seed of the random generators of island i
+def island_seed(random_seed, i):
+    return random_seed * 1000 + i
+
+
+# the link of one GA (run_ga) with the other islands
+class Island(object):
+    """
+    Given to run_ga, which calls migrate at the end of each generation and report after logging it.
+    Every interval generations the island sends its n_migrants best (or most novel) individuals to
+    each destination, then waits for the emigrants of all its sources: they replace its worst
+    individuals. Migration is synchronous, so a run is reproducible from its seed.
+
+    ...
+
+    Parameters
+    ----------
+    index : int
+        index of the island
+    n_islands : int
+        number of islands
+    dir_out : str
+        output dir of the island
+    pop_size : int
+        population size of the island
+    inboxes : list
+        one multiprocessing.Queue of incoming migrants per island
+    reports : multiprocessing.Queue
+        per-generation statistics, for the coordinator
+    interval : int
+        generations between migrations, 0 = never
+    n_migrants : int
+        individuals sent to each destination
+    topology : str
+        "ring" (to the next island) or "full" (to all the others)
+    criterion : str
+        "best" (fitness, as tools.selBest) or "novel" (novelty)
+    timeout : float
+        max seconds waiting for the migrants of a source
+    """
+
+    def __init__(self, index, n_islands, dir_out, pop_size, inboxes, reports, interval=constants.MIGRATION_GENS,
+                 n_migrants=constants.MIGRANTS, topology=constants.MIGRATION_TOPOLOGY,
+                 criterion=constants.MIGRATION_CRITERION, timeout=constants.MIGRATION_TIMEOUT):
+        if criterion not in ("best", "novel"):
+            raise ValueError("invalid migration criterion: " + str(criterion))
+        self.index = index
+        self.n_islands = n_islands
+        self.dir_out = dir_out
+        self.pop_size = pop_size
+        self.inboxes = inboxes
+        self.reports = reports
+        self.interval = interval
+        self.n_migrants = n_migrants
+        self.topology = topology
+        self.criterion = criterion
+        self.timeout = timeout
+        self.sources, self.destinations = neighbours(index, n_islands, topology)
+        # migrants received ahead of time: generation -> {source: migrants}
+        self.received = dict()
+
+    def config(self):
+        return {"index": self.index, "islands": self.n_islands, "interval": self.interval,
+                "migrants": self.n_migrants, "topology": self.topology, "criterion": self.criterion,
+                "sources": self.sources, "destinations": self.destinations}
+
+    def emigrants(self, pop):
+        """The n_migrants individuals sent by the island, as (genome, fitness values)"""
+        if self.criterion == "novel":
+            order = sorted(range(len(pop)), key=lambda i: pop[i].fitness.values[1], reverse=True)
+        else:
+            order = sorted(range(len(pop)), key=lambda i: pop[i].fitness.wvalues, reverse=True)
+        return [(list(pop[i]), pop[i].fitness.values) for i in order[:self.n_migrants]]
+
+    def migrate(self, g, pop):
+        """Exchange migrants after generation g (pop is changed in place), return the counts"""
+        if self.interval <= 0 or not self.sources or (g + 1) % self.interval != 0:
+            return {"emigrants": 0, "immigrants": 0}
+        sent = self.emigrants(pop)
+        for d in self.destinations:
+            self.inboxes[d].put((g, self.index, sent))
+        # islands can be one migration ahead: keep their migrants for the next one
+        while len(self.received.get(g, ())) < len(self.sources):
+            try:
+                g_src, src, migrants = self.inboxes[self.index].get(timeout=self.timeout)
+            except queue.Empty:
+                raise RuntimeError("island " + str(self.index) + ": no migrants at generation " + str(g))
+            self.received.setdefault(g_src, dict())[src] = migrants
+        received = self.received.pop(g)
+        immigrants = []
+        for src in sorted(received):
+            for genome, values in received[src]:
+                ind = type(pop[0])(genome)
+                ind.fitness.values = values
+                immigrants.append(ind)
+        # the immigrants (the best of them, if too many) replace the worst individuals
+        immigrants.sort(key=lambda x: x.fitness.wvalues, reverse=True)
+        immigrants = immigrants[:max(0, len(pop) - constants.N_ELITE)]
+        worst = sorted(range(len(pop)), key=lambda i: pop[i].fitness.wvalues)[:len(immigrants)]
+        for i, ind in zip(worst, immigrants):
+            pop[i] = ind
+        return {"emigrants": len(sent) * len(self.destinations), "immigrants": len(immigrants)}
+
+    def report(self, g, method, fitness, archive_size, feasible, migration):
+        """Send the statistics of generation g to the coordinator"""
+        fits = [x[0] for x in fitness]
+        record = {"island": self.index, "method": method, "fitness_mean": sum(fits) / len(fits),
+                  "fitness_min": min(fits), "fitness_max": max(fits),
+                  "novelty_mean": sum(x[1] for x in fitness) / len(fitness), "archive": archive_size,
+                  "feasible": feasible}
+        record.update(migration)
+        self.reports.put((g, record))
+
+
+# process of an island
+def _run_island(file_in, random_seed, novelty_method, island):
+    sys.stdout = sys.stderr = open(island.dir_out + "out.txt", "a", buffering=1)
+    main.run_ga(file_in, random_seed, novelty_method, island=island)
+
+
+def run_islands(file_in, random_seed, novelty_method, n_islands=constants.ISLANDS, pop_size=constants.POP_SIZE,
+                **kwargs):
+    """
+    Run n_islands GAs of pop_size individuals (n_islands * pop_size in total) in separate processes.
+    Each island writes its own run log (with the migration counts) in dir_out/island_<i>/;
+    dir_out/islands.jsonl has the statistics of every island, one record per generation.
+
+    ...
+
+    Parameters
+    ----------
+    file_in : str
+        model name (data/models/file_in)
+    random_seed : int
+        seed of the run, island i uses island_seed(random_seed, i)
+    novelty_method : str
+        as in run_ga
+    n_islands : int
+        number of islands (processes)
+    pop_size : int
+        population size of each island
+    kwargs
+        migration parameters of Island (interval, n_migrants, topology, criterion, timeout)
+
+    Returns
+    -------
+    str
+        dir_out
+    """
+    start_time = datetime.now()
+    dir_out = "data/out/" + file_in + "/islands_" + novelty_method + "_" + str(random_seed) + "_" + \
+        start_time.strftime("%Y%m%d-%H.%M.%S")
+    # runs started in the same second get a suffix
+    os.makedirs("data/out/" + file_in, exist_ok=True)
+    suffix = ""
+    while True:
+        try:
+            os.mkdir(dir_out + suffix)
+            break
+        except FileExistsError:
+            suffix = "_" + str(int(suffix[1:] or 1) + 1)
+    dir_out = dir_out + suffix + "/"
+
+    inboxes = [mp.Queue() for _ in range(n_islands)]
+    reports = mp.Queue()
+    islands = [Island(i, n_islands, dir_out + "island_" + str(i) + "/", pop_size, inboxes, reports, **kwargs)
+               for i in range(n_islands)]
+    log = run_log.RunLog(dir_out + "islands.jsonl")
+    log.write({"const": {"file_in": file_in, "NGEN": constants.NGEN, "POP_SIZE": pop_size, "ISLANDS": n_islands},
+               "method": novelty_method, "random_seed": random_seed, "island": islands[0].config()})
+    for x in islands:
+        os.makedirs(x.dir_out, exist_ok=True)
+    processes = [mp.Process(target=_run_island, args=(file_in, island_seed(random_seed, x.index), novelty_method, x))
+                 for x in islands]
+    for p in processes:
+        p.start()
+
+    # one record per generation, when all the islands have reported it
+    pending = dict()
+    failed = []
+    while True:
+        try:
+            g, record = reports.get(timeout=1.0)
+        except queue.Empty:
+            failed = [i for i, p in enumerate(processes) if p.exitcode not in (None, 0)]
+            if failed or all(p.exitcode == 0 for p in processes):
+                break
+            continue
+        pending.setdefault(g, []).append(record)
+        if len(pending[g]) == n_islands:
+            log.write({"g": g, "islands": sorted(pending.pop(g), key=lambda r: r["island"])})
+            if g == constants.NGEN - 1:
+                break
+    if failed:
+        # the other islands would wait for the migrants of the failed ones
+        for p in processes:
+            p.terminate()
+    for p in processes:
+        p.join()
+    failed = failed or [i for i, p in enumerate(processes) if p.exitcode != 0]
+    end = {"time": (datetime.now() - start_time).total_seconds()}
+    if failed:
+        end["failed"] = failed
+    log.write(end)
+    log.close()
+    print("islands time elapsed :", end["time"], "sec.")
+    if failed:
+        raise RuntimeError("islands failed: " + str(failed) + " (see " + dir_out + "island_<i>/out.txt)")
+    return dir_out
+
+
+if __name__ == "__main__":
+    run_islands(sys.argv[1] if len(sys.argv) > 1 else "input",
+                int(sys.argv[2]) if len(sys.argv) > 2 else 8,
+                sys.argv[3] if len(sys.argv) > 3 else "multi_log_genotype")
@@ -1,32 +1,49 @@
-import json
 import os
 import random
-from datetime import datetime
+import sys
+from datetime import datetime, timedelta
 import numpy
 from deap import base, creator, tools
 import plots
 import markov
 import deap_ops
+import executors
+import checkpoint
+import novelty_search
+import phase_timer
+import run_log
 import constants
 
 
-def run_ga(file_in, random_seed, novelty_method):
+def run_ga(file_in, random_seed, novelty_method, resume_dir=None, island=None):
 
     # set random seed
     random.seed(random_seed)
     numpy.random.seed(random_seed)
 
-    root_out = "data/out/" + file_in + "/"
-    dir_out = root_out + novelty_method + "_" + str(random_seed) + "_" + datetime.now().strftime("%Y%m%d-%H.%M.%S") + "/"
-
-    # Create target dir if don't exist
-    if not os.path.exists(root_out):
-        os.mkdir(root_out)
-    # Create dir_out if don't exist
-    if not os.path.exists(dir_out):
-        os.mkdir(dir_out)
+    # population size (of the island, in the island model: see islands.Island)
+    pop_size = island.pop_size if island is not None else constants.POP_SIZE
+    # thresholds of feasible individuals switching to novelty and back, tuned for POP_SIZE
+    nov_t_min = round(constants.NOV_T_MIN * pop_size / constants.POP_SIZE)
+    nov_t_max = round(constants.NOV_T_MAX * pop_size / constants.POP_SIZE)
+
+    if resume_dir:
+        # continue the run in resume_dir, from its checkpoint
+        dir_out = resume_dir.rstrip("/") + "/"
+    elif island is not None:
+        dir_out = island.dir_out
+        os.makedirs(dir_out, exist_ok=True)
     else:
-        print("Directory ", dir_out, "already exists")
+        root_out = "data/out/" + file_in + "/"
+        dir_out = root_out + novelty_method + "_" + str(random_seed) + "_" + datetime.now().strftime("%Y%m%d-%H.%M.%S") + "/"
+
+        # Create target dir if don't exist (concurrent runs may create it too)
+        os.makedirs(root_out, exist_ok=True)
+        # Create dir_out if don't exist
+        if not os.path.exists(dir_out):
+            os.mkdir(dir_out)
+        else:
+            print("Directory ", dir_out, "already exists")
 
     # read input model and form classes
     # for generation and evaluation of individuals
@@ -40,20 +57,25 @@ def run_ga(file_in, random_seed, novelty_method):
     # time
     start_time = datetime.now()
 
+    # per-phase wall time and counters of the generations (a disabled timer costs nothing)
+    timer = phase_timer.PhaseTimer(enabled=constants.PROFILE)
+
     # init archive
-    archive = []
+    archive = novelty_search.NoveltyArchive(constants.ARCH_CAPACITY, constants.ARCH_POLICY)
 
     # STATS
     stats = dict()
     stats["const"] = dict()
     stats["const"]["file_in"] = file_in
     stats["const"]["NGEN"] = constants.NGEN
-    stats["const"]["POP_SIZE"] = constants.POP_SIZE
+    stats["const"]["POP_SIZE"] = pop_size
     stats["const"]["N_ELITE"] = constants.N_ELITE
-    stats["const"]["NOV_T_MIN"] = constants.NOV_T_MIN
-    stats["const"]["NOV_T_MAX"] = constants.NOV_T_MAX
+    stats["const"]["NOV_T_MIN"] = nov_t_min
+    stats["const"]["NOV_T_MAX"] = nov_t_max
     stats["const"]["NOV_FIT_THRESH"] = constants.NOV_FIT_THRESH
     stats["method"] = novelty_method
+    if island is not None:
+        stats["island"] = island.config()
 
     # for plot
     fits = []
@@ -80,72 +102,126 @@ def run_ga(file_in, random_seed, novelty_method):
     # selection
     toolbox.register("select", tools.selSPEA2)
     # eval
-    toolbox.register("evaluate", lambda x: (deap_ops.eval_fitness(x, tps), 0))
-    toolbox.register("evaluateMulti", lambda x: deap_ops.eval_fitness_and_novelty(x, tps, pop, archive))
-
-    # evaluation function: (fitness or fitness-novelty)
-    evaluation_function = toolbox.evaluate
+    # opt-in fitness memo (genomes repeated by elites, clones and crossover)
+    fit_cache = deap_ops.FitnessCache(constants.FIT_CACHE_SIZE) if constants.FIT_CACHE_SIZE > 0 else None
+    # executor for the (batch, incremental) fitness: serial, thread or process pool
+    evaluator = executors.Evaluator(tps, mode=constants.EVAL_MODE, workers=constants.EVAL_WORKERS)
+    toolbox.register("map", evaluator.map)
+
+    def fitness_population(xs, t, cache=None):
+        return deap_ops.eval_fitness_population(xs, t, cache=cache, fitness_fun=evaluator.fitness)
+
+    toolbox.register("evaluate", lambda x: (deap_ops.eval_fitness(x, tps, cache=fit_cache), 0))
+    toolbox.register("evaluateMulti",
+                     lambda x: deap_ops.eval_fitness_and_novelty(x, tps, pop, archive, cache=fit_cache))
+    # eval a list of individuals at once
+    def evaluate_pop(xs):
+        with timer.phase("fitness"):
+            return [(f, 0) for f in fitness_population(xs, tps, cache=fit_cache)]
+
+    toolbox.register("evaluatePop", evaluate_pop)
+    toolbox.register("evaluateMultiPop",
+                     lambda xs: deap_ops.eval_fitness_and_novelty_population(
+                         xs, tps, pop, archive, fitness_fun=fitness_population, cache=fit_cache, timer=timer))
+
+    # evaluation function: (fitness or fitness-novelty), on the whole list of individuals
+    evaluation_function = toolbox.evaluatePop
     feasible_individuals = 0
     # create the population
-    pop = toolbox.population(n=constants.POP_SIZE)
+    pop = toolbox.population(n=pop_size)
+
+    # generations are appended to the run log as they end (read_stats rebuilds the whole stats)
+    g_start = 0
+    if resume_dir:
+        # restore the state at the end of the checkpoint generation (and the log up to it)
+        state = checkpoint.load(dir_out + "checkpoint.pkl")
+        g_start = state["g"]
+        pop = state["pop"]
+        archive = state["archive"]
+        feasible_individuals = state["feasible_individuals"]
+        evaluation_function = toolbox.evaluateMultiPop if state["multi"] else toolbox.evaluatePop
+        fits, novs, arch_s = state["fits"], state["novs"], state["arch_s"]
+        timer = state.get("timer", timer)
+        timer.enabled = constants.PROFILE
+        if fit_cache is not None and state["fit_cache"] is not None:
+            fit_cache = state["fit_cache"]
+        start_time = datetime.now() - timedelta(seconds=state["elapsed"])
+        random.setstate(state["random"])
+        numpy.random.set_state(state["numpy_random"])
+        log = run_log.RunLog(dir_out + "run_log.jsonl", size=state["log_size"], archive=archive)
+        print("Resuming", dir_out, "from generation", g_start)
+    else:
+        log = run_log.RunLog(dir_out + "run_log.jsonl")
+        log.write(stats)
+    last_checkpoint = datetime.now()
+    # fitness cache counters at the end of the last generation
+    cache_hits, cache_misses = (fit_cache.hits, fit_cache.misses) if fit_cache is not None else (0, 0)
 
     # generations
-    for g in range(constants.NGEN):
-
-        # new stats page
-        stats[g] = dict()
+    for g in range(g_start, constants.NGEN):
 
         # novelty search: choose evaluate function (fitness or multi)
         if novelty_method.find("fitness_only") == -1:
-            if feasible_individuals >= constants.NOV_T_MAX:
+            if feasible_individuals >= nov_t_max:
                 # fitness + novelty
-                evaluation_function = toolbox.evaluateMulti
-            elif feasible_individuals <= constants.NOV_T_MIN:
+                evaluation_function = toolbox.evaluateMultiPop
+            elif feasible_individuals <= nov_t_min:
                 # fitness
-                evaluation_function = toolbox.evaluate
+                evaluation_function = toolbox.evaluatePop
 
         ###################################################################
 
         # EVALUATION
-        # t1 = datetime.now()
-        feasible_individuals = 0
-        fit_values = list(map(evaluation_function, pop))
-        for ind, fit in zip(pop, fit_values):
-            ind.fitness.values = fit
-            # count feasible individuals for novelty search
-            if fit[0] > constants.NOV_FIT_THRESH:
-                feasible_individuals = feasible_individuals + 1
-        # print("Eval... time: ", (datetime.now() - t1).total_seconds(), "s.")
+        with timer.phase("evaluation"):
+            feasible_individuals = 0
+            fit_values = evaluation_function(pop)
+            for ind, fit in zip(pop, fit_values):
+                ind.fitness.values = fit
+                # count feasible individuals for novelty search
+                if fit[0] > constants.NOV_FIT_THRESH:
+                    feasible_individuals = feasible_individuals + 1
+        timer.count("evaluations", len(pop))
 
         # SELECTION
-        offspring = list(map(toolbox.clone, toolbox.select(pop, k=constants.POP_SIZE - constants.N_ELITE)))
-        elite = list(map(toolbox.clone, offspring[:constants.N_ELITE]))  # Select the elite
+        with timer.phase("selection"):
+            selected = toolbox.select(pop, k=pop_size - constants.N_ELITE)
+        with timer.phase("cloning"):
+            offspring = list(map(toolbox.clone, selected))
+            elite = list(map(toolbox.clone, offspring[:constants.N_ELITE]))  # Select the elite
 
         random.shuffle(offspring)
 
         # CROSSOVER
-        for child1, child2 in zip(offspring[::2], offspring[1::2]):
-            if random.random() < constants.CXPB:
-                toolbox.mate(child1, child2)
-                del child1.fitness.values
-                del child2.fitness.values
+        with timer.phase("crossover"):
+            for child1, child2 in zip(offspring[::2], offspring[1::2]):
+                if random.random() < constants.CXPB:
+                    toolbox.mate(child1, child2)
+                    del child1.fitness.values
+                    del child2.fitness.values
 
         # MUTATION
-        for mutant in offspring:
-            if random.random() < constants.MUTPB:
-                toolbox.mutate(mutant)
-                del mutant.fitness.values
+        with timer.phase("mutation"):
+            for mutant in offspring:
+                if random.random() < constants.MUTPB:
+                    toolbox.mutate(mutant)
+                    del mutant.fitness.values
 
         # Evaluate the individuals with an invalid fitness
-        # t2 = datetime.now()
-        invalid_ind = [ind for ind in offspring if not ind.fitness.valid]
-        values = toolbox.map(evaluation_function, invalid_ind)
-        for ind, fit in zip(invalid_ind, values):
-            ind.fitness.values = fit
-        # print("Eval invalid...", "time: " + str((datetime.now() - t2).total_seconds()))
+        with timer.phase("reevaluation"):
+            invalid_ind = [ind for ind in offspring if not ind.fitness.valid]
+            values = evaluation_function(invalid_ind)
+            for ind, fit in zip(invalid_ind, values):
+                ind.fitness.values = fit
+        timer.count("evaluations", len(invalid_ind))
 
         # new pop
         pop[:] = elite + offspring
+
+        # MIGRATION (island model): emigrants sent and immigrants in place of the worst individuals
+        migration = dict()
+        if island is not None:
+            with timer.phase("migration"):
+                migration = dict(island=island.migrate(g, pop))
         ###################################################################
         # SAVE STATISTICS
 
@@ -159,25 +235,54 @@ def run_ga(file_in, random_seed, novelty_method):
         # else:
         #     print("FATAL ERROR: NO METHOD FOUND")
 
-        res = [ind.fitness.values for ind in pop]
-        fits.append(sum(x[0] for x in res) / constants.POP_SIZE)
-        novs.append(sum(x[1] for x in res) / constants.POP_SIZE)
-        arch_s.append(len(archive))
-
-        # save stats
-        # in case use copy.deepcopy()
-        stats[g]["method"] = "F" if evaluation_function == toolbox.evaluate else "H"
-        # stats[g]["method"] = "H"
-        stats[g]["pop"] = pop[:]
-        stats[g]["fitness"] = res[:]
-        stats[g]["archive"] = archive[:]
+        with timer.phase("stats"):
+            res = [ind.fitness.values for ind in pop]
+            fits.append(sum(x[0] for x in res) / pop_size)
+            novs.append(sum(x[1] for x in res) / pop_size)
+            arch_s.append(len(archive))
+            archive_counters = archive.generation_counters()
+        timer.count("archive_assessments", archive_counters["assessments"])
+        timer.count("archive_admissions", archive_counters["admissions"])
+        if fit_cache is not None:
+            timer.count("cache_hits", fit_cache.hits - cache_hits)
+            timer.count("cache_misses", fit_cache.misses - cache_misses)
+            cache_hits, cache_misses = fit_cache.hits, fit_cache.misses
+
+        # save stats (with the timing of the generation, when measured)
+        timing = dict(timing=timer.end_generation()) if timer.enabled else dict()
+        log.generation(g, method="F" if evaluation_function == toolbox.evaluatePop else "H",
+                       pop=pop, fitness=res, archive=archive, archive_counters=archive_counters,
+                       **timing, **migration)
+        if island is not None:
+            island.report(g, "F" if evaluation_function == toolbox.evaluatePop else "H", res, len(archive),
+                          feasible_individuals, migration["island"])
+
+        # checkpoint every CHECKPOINT_GENS generations or CHECKPOINT_SECS seconds (not the islands)
+        if island is None and ((constants.CHECKPOINT_GENS and (g + 1) % constants.CHECKPOINT_GENS == 0) or
+                               (constants.CHECKPOINT_SECS and
+                                (datetime.now() - last_checkpoint).total_seconds() >= constants.CHECKPOINT_SECS)):
+            checkpoint.save(dir_out + "checkpoint.pkl", {
+                "file_in": file_in, "random_seed": random_seed, "novelty_method": novelty_method,
+                "g": g + 1, "pop": pop, "archive": archive, "feasible_individuals": feasible_individuals,
+                "multi": evaluation_function == toolbox.evaluateMultiPop, "fits": fits, "novs": novs,
+                "arch_s": arch_s, "fit_cache": fit_cache, "timer": timer,
+                "elapsed": (datetime.now() - start_time).total_seconds(),
+                "random": random.getstate(), "numpy_random": numpy.random.get_state(), "log_size": log.size()})
+            last_checkpoint = datetime.now()
 
     # end ga
+    evaluator.close()
 
     ###############################################################
     #                   OUT, PLOTS and GRAPHS
     ###############################################################
-    stats["time"] = (datetime.now() - start_time).total_seconds()
+    end = {"time": (datetime.now() - start_time).total_seconds()}
+    if fit_cache is not None:
+        end["fitness_cache"] = fit_cache.stats()
+    if timer.enabled:
+        end["timing"] = timer.totals()
+    log.write(end)
+    log.close()
 
     pop_plot = {"fits": [], "novs": []}
     best_plot = {"fits":[], "novs":[]}
@@ -191,16 +296,27 @@ def run_ga(file_in, random_seed, novelty_method):
         best_plot["fits"].append(bb.fitness.values[0])
         best_plot["novs"].append(bb.fitness.values[1])
 
-    print("time elapsed :", stats["time"], "sec.")
+    print("time elapsed :", end["time"], "sec.")
+    if timer.enabled:
+        print(timer.summary())
 
-    # save stats
-    with open(dir_out + "stats.json", "w") as fp:
-        json.dump(stats, fp, default=markov.serialize_sets)
+    # save stats (the whole structure, for the old analysis scripts)
+    if constants.STATS_JSON:
+        run_log.write_stats_json(dir_out + "run_log.jsonl", dir_out + "stats.json")
 
     # plots.plot_fits(dir_out, constants.NGEN, fits, novs, stats["method"])
     plots.plot_data(dir_out, constants.NGEN, fits, novs, arch_s, stats["method"])
     plots.plot_pareto(dir_out, pop_plot, best_plot, stats["method"])
 
 
+# continue an interrupted run from the checkpoint in its dir_out
+def resume_ga(dir_out):
+    state = checkpoint.load(dir_out.rstrip("/") + "/checkpoint.pkl")
+    return run_ga(state["file_in"], state["random_seed"], state["novelty_method"], resume_dir=dir_out)
+
+
 if __name__ == "__main__":
-    run_ga("input", 8, "fitness_only")
+    if len(sys.argv) > 2 and sys.argv[1] == "resume":
+        resume_ga(sys.argv[2])
+    else:
+        run_ga("input", 8, "fitness_only")
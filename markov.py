@@ -1,11 +1,17 @@
 #!/usr/bin/env python
+import hashlib
 import json
 import math
+import multiprocessing as mp
 import os
 import pprint
 import random
-from collections import OrderedDict
+import zipfile
+from bisect import bisect_left
+from collections import Counter, OrderedDict, deque
+from itertools import accumulate
 import numpy as np
+from ngram_trie import NgramTrie
 
 
 # sort key selector function
@@ -50,6 +56,9 @@ def ngram_occurrences(seqs, order_limit=6, sort=True):
 def markov_trans_occ(seqs, order_limit=6):
     """This function computes transition occurrences dict up to order-limit
 
+    Single pass: each token is visited once and counted for all orders together.
+    Same tables (and same keys order) as the cumulative per-order counting.
+
     ...
 
     Parameters
@@ -59,6 +68,38 @@ def markov_trans_occ(seqs, order_limit=6):
     order_limit : int
         the maximum ngram length calculated
     """
+    # counts[order]: context tuple -> {next symbol: occ.}, 0th-order: symbol -> occ.
+    counts = [dict() for _ in range(order_limit)]
+    for arr in seqs:
+        update_trans_occ(counts, [str(e) for e in arr])
+    return trans_occ_to_dict(counts)
+
+
+# count the transitions of one sequence for all orders (in place)
+def update_trans_occ(counts, arr):
+    order_limit = len(counts)
+    occ0 = counts[0]
+    for j, sym in enumerate(arr):
+        occ0[sym] = occ0.get(sym, 0) + 1
+        for order in range(1, min(order_limit, j + 1)):
+            past = tuple(arr[j - order:j])
+            nxt = counts[order].get(past)
+            if nxt is None:
+                counts[order][past] = {sym: 1}
+            else:
+                nxt[sym] = nxt.get(sym, 0) + 1
+
+
+# convert counts (tuple contexts) into the occurrences dict (space-joined contexts)
+def trans_occ_to_dict(counts):
+    dic = {0: counts[0]}
+    for order in range(1, len(counts)):
+        dic[order] = {" ".join(past): nxt for past, nxt in counts[order].items()}
+    return dic
+
+
+# reference (cumulative, per order) implementation of markov_trans_occ, used by check_trans_occ
+def _markov_trans_occ_reference(seqs, order_limit=6):
     dic = dict()
     for order in range(order_limit):
         dic[order] = dict()
@@ -90,6 +131,22 @@ def markov_trans_occ(seqs, order_limit=6):
     return dic
 
 
+# compare markov_trans_occ with the reference implementation (values and keys order)
+def check_trans_occ(seqs, order_limit=6):
+    res = markov_trans_occ(seqs, order_limit)
+    ref = _markov_trans_occ_reference(seqs, order_limit)
+    if res != ref:
+        return False
+    for order in ref.keys():
+        if list(res[order].keys()) != list(ref[order].keys()):
+            return False
+        if order > 0:
+            for past in ref[order].keys():
+                if list(res[order][past].items()) != list(ref[order][past].items()):
+                    return False
+    return True
+
+
 # calculates probabilities of markov transitions
 def markov_trans_freq(seqs, order_limit=6):
     """This function computes transition frequencies dict up to order-limit
@@ -103,7 +160,11 @@ def markov_trans_freq(seqs, order_limit=6):
     order_limit : int
         the maximum ngram length calculated
     """
-    cto = markov_trans_occ(seqs, order_limit)
+    return trans_occ_to_freq(markov_trans_occ(seqs, order_limit))
+
+
+# calculates probabilities of markov transitions from the transition occurrences
+def trans_occ_to_freq(cto):
     m = dict()
     t_tot = 0
     for itm in cto.items():
@@ -203,9 +264,10 @@ def markov_trans_prob(seqs, order_limit=6):
 
 
 # switch tokens with their transitional probabilities in the given sequences
-def detect_transitions(sequences, mtp):
+def detect_transitions(sequences, mtp, numeric=False, padded=False, dtype=np.float32):
     """
     Read a list of sequences and switch each occurrence with its transitional probability.
+    Positions with no transition (the first #order ones) are "-", or NaN if numeric.
 
     ...
 
@@ -213,37 +275,245 @@ def detect_transitions(sequences, mtp):
     ----------
     sequences : matrix
         list of sequences to analyze
-    mtp : dict
+    mtp : dict or NgramTrie
         the transitional probabilities dictionary
+    numeric : bool
+        return, for each order, a list of float arrays (built by vectorized lookups on the NgramTrie)
+        instead of lists of "-" and floats
+    padded : bool
+        if numeric, return a matrix for each order, rows are padded with NaN
+    dtype : type
+        if numeric, float type of the arrays
     """
+    if numeric:
+        return numeric_transitions(sequences, mtp, padded, dtype)
     res = dict()
     for order in mtp.items():
         res[order[0]] = list()
         for seq in sequences:
-            if len(seq) > int(order[0]):
-                sq = list()
-                # fill in initial n (#order)empty chars
-                for i in range(order[0]):
-                    sq.append("-")
-                for _ind in zip(*[seq[_x:] for _x in range(order[0] + 1)]):
-                    i1 = " ".join(_ind[:-1])  # trim last space
-                    i2 = str(_ind[-1])
-                    if not i1:
-                        # order 1 ..then takes each tokens
-                        ns = order[1][i2]
-                    else:
-                        # high order ..is a dict
-                        ns = order[1][i1][i2]
-                    sq.append(ns)
-                res[order[0]].append(sq)
+            res[order[0]].append(detect_sequence_transitions(seq, order[0], order[1]))
+    return res
+
+
+# tf_seqs as float arrays, NaN where there is no transition
+def numeric_transitions(sequences, mtp, padded=False, dtype=np.float32, orders=None):
+    trie = mtp if isinstance(mtp, NgramTrie) else NgramTrie.from_dict(mtp)
+    if orders is None:
+        orders = range(trie.max_order + 1)
+    lengths = np.array([len(seq) for seq in sequences], dtype=np.int64)
+    # all the sequences in one array, contexts never cross sequences since positions i < order are NaN
+    flat = trie.encode([str(x) for seq in sequences for x in seq])
+    inpos = np.arange(len(flat)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    res = dict()
+    for order in orders:
+        edges = trie.transition_edges(flat, order)
+        missing = (edges < 0) & (inpos >= order)
+        if np.any(missing):
+            raise KeyError(str(trie.decode(flat[np.flatnonzero(missing)[:1]])))
+        vals = np.where(inpos >= order, trie.edge_prob[np.maximum(edges, 0)], np.nan).astype(dtype)
+        rows = np.split(vals, np.cumsum(lengths)[:-1])
+        # sequences too short have no transitions
+        rows = [row if len(row) > order else row[:0] for row in rows]
+        if padded:
+            mat = np.full((len(rows), int(lengths.max()) if len(rows) > 0 else 0), np.nan, dtype=dtype)
+            for i, row in enumerate(rows):
+                mat[i, :len(row)] = row
+            rows = mat
+        res[order] = rows
+    return res
+
+
+# write numeric tf_seqs ((order, rows) items, rows can be ragged) in a compressed .npz file, one order at a time
+def save_tf_seqs(path, items):
+    def batches():
+        for order, rows in items:
+            dtype = np.asarray(rows[0]).dtype if len(rows) > 0 else np.float32
+            yield order, [len(row) for row in rows], [rows], dtype
+    save_tf_seqs_batches(path, batches())
+
+
+# write numeric tf_seqs as save_tf_seqs, from (order, lengths of the rows, batches of rows, dtype) items:
+# the rows are streamed into the .npz members, a batch at a time
+def save_tf_seqs_batches(path, items):
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+        for order, lengths, batches, dtype in items:
+            lengths = np.asarray(lengths, dtype=np.int64)
+            total = int(lengths.sum())
+            with zf.open("values_%d.npy" % order, "w", force_zip64=True) as fp:
+                np.lib.format.write_array_header_1_0(fp, {"descr": np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                                                          "fortran_order": False, "shape": (total,)})
+                written = 0
+                for rows in batches:
+                    if len(rows) > 0:
+                        values = np.concatenate([np.asarray(row, dtype=dtype) for row in rows])
+                        fp.write(values.tobytes())
+                        written += len(values)
+                if written != total:
+                    raise ValueError("tf_seqs of order %d: %d values written, %d expected" % (order, written, total))
+            with zf.open("lengths_%d.npy" % order, "w", force_zip64=True) as fp:
+                np.lib.format.write_array(fp, lengths)
+
+
+# read the numeric tf_seqs written by save_tf_seqs
+def load_tf_seqs(path, padded=False):
+    res = dict()
+    with np.load(path) as data:
+        orders = sorted(int(name.split("_")[1]) for name in data.files if name.startswith("values_"))
+        for order in orders:
+            values = data["values_%d" % order]
+            lengths = data["lengths_%d" % order]
+            rows = np.split(values, np.cumsum(lengths)[:-1]) if len(lengths) > 0 else []
+            if padded:
+                mat = np.full((len(rows), int(lengths.max()) if len(rows) > 0 else 0), np.nan, dtype=values.dtype)
+                for i, row in enumerate(rows):
+                    mat[i, :len(row)] = row
+                rows = mat
+            res[order] = rows
+    return res
+
+
+# switch tokens of one sequence with their transitional probabilities of the given order
+def detect_sequence_transitions(seq, order, mtp_order):
+    if len(seq) > int(order):
+        sq = list()
+        # fill in initial n (#order)empty chars
+        for i in range(order):
+            sq.append("-")
+        for _ind in zip(*[seq[_x:] for _x in range(order + 1)]):
+            i1 = " ".join(_ind[:-1])  # trim last space
+            i2 = str(_ind[-1])
+            if not i1:
+                # order 1 ..then takes each tokens
+                ns = mtp_order[i2]
             else:
-                # sequence too short
-                res[order[0]].append([])
+                # high order ..is a dict
+                ns = mtp_order[i1][i2]
+            sq.append(ns)
+        return sq
+    else:
+        # sequence too short
+        return []
+
+
+# convert sequences of symbols into arrays of integer ids
+def tokenize(seqs):
+    """
+    Return (ids, vocab): one array of ids per sequence, and the vocabulary (vocab[id] = symbol)
+    """
+    index = dict()
+    vocab = []
+    ids = []
+    for seq in seqs:
+        row = np.empty(len(seq), dtype=np.int64)
+        for j, x in enumerate(seq):
+            x = str(x)
+            if x not in index:
+                index[x] = len(vocab)
+                vocab.append(x)
+            row[j] = index[x]
+        ids.append(row)
+    return ids, vocab
+
+
+# positions of the sequence whose transition is "sure" (no transition or tp >= thr)
+def _sure_mask(x, thr):
+    if isinstance(x, np.ndarray) and x.dtype.kind == "f":
+        return np.isnan(x) | (x >= thr)
+    # the first (order) positions have no transition
+    k = 0
+    while k < len(x) and str(x[k]) == "-":
+        k += 1
+    try:
+        return np.concatenate((np.ones(k, dtype=bool), np.asarray(x[k:], dtype=np.float64) >= thr))
+    except ValueError:
+        return np.array([str(v) == "-" or float(v) >= thr for v in x], dtype=bool)
+
+
+# count the chunks of one order, working on spans of ids
+def _order_chunks(args):
+    ids, rows, vocab, thr, only_sure, order = args
+    spans = Counter()
+    res = Counter()
+    for seq, x in zip(ids, rows):
+        # numeric rows can be padded, sequences too short have no transitions
+        x = x[:len(seq)]
+        if len(x) == 0 or len(seq) <= order:
+            continue
+        seq = seq.tolist()
+        breaks = np.flatnonzero(~_sure_mask(x, thr)).tolist()
+        if only_sure:
+            # a chunk ends at every break, only chunks longer than a symbol are kept
+            a = 0
+            for b in breaks:
+                spans[tuple(seq[a:b])] += 1
+                a = b
+            continue
+        # a chunk ends at every break and the next one starts there (unless there is no chunk,
+        # or the symbol is empty), the last chunk is kept if it is not the entire sequence
+        a = None
+        pos = 0
+        for b in breaks:
+            if a is None and b > pos:
+                a = pos
+            if a is not None:
+                spans[tuple(seq[a:b])] += 1
+                a = b if vocab[seq[b]] != "" else None
+            pos = b + 1
+        if a is None and pos < len(x):
+            a = pos
+        if a is not None:
+            cks = " ".join([vocab[t] for t in seq[a:len(x)]]).strip(" ")
+            if cks != "" and cks != " ".join([vocab[t] for t in seq]):
+                res[cks] += 1
+    # chunks as strings, only now
+    for span, n in spans.items():
+        cks = " ".join([vocab[t] for t in span]).strip(" ")
+        if not only_sure or len(cks.split(" ")) > 1:
+            res[cks] += n
     return res
 
 
+# chunks of each order, with their frequencies
+def chunk_frequencies(seqs, mtp, mkv_thr, orders=[2, 3, 4], only_sure=False, workers=1):
+    """
+    Returns segments/chunks of seqs extracted using mtp transitions, with their number of occurrences.
+    Chunks are spans of the (integer tokenized) sequences between transitions below mkv_thr
+    (see chunk_sequences and chunk_sequences_only_sure); orders are processed in parallel.
+
+    ...
+
+    Parameters
+    ----------
+    seqs : matrix
+        list of sequences to analyze
+    mtp : dict
+        the transitional probabilities sequences (as computed by detect_transitions, also numeric)
+    mkv_thr : float
+        threshold of the transitions inside a chunk
+    orders : list
+        orders in dict
+    only_sure : bool
+        as chunk_sequences_only_sure: only chunks of more than one symbol, the last chunk is discarded
+    workers : int
+        number of processes
+
+    Returns
+    -------
+    dict
+        order -> Counter of chunks
+    """
+    ids, vocab = tokenize(seqs)
+    tasks = [(ids, mtp[order], vocab, mkv_thr, only_sure, order) for order in orders]
+    if workers > 1 and len(tasks) > 1:
+        with mp.Pool(min(workers, len(tasks))) as pool:
+            counts = pool.map(_order_chunks, tasks)
+    else:
+        counts = map(_order_chunks, tasks)
+    return dict(zip(orders, counts))
+
+
 # chunking sequences
-def chunk_sequences(seqs, mtp, mkv_thr, orders=[2, 3, 4]):
+def chunk_sequences(seqs, mtp, mkv_thr, orders=[2, 3, 4], workers=1):
     """
     Returns segments/chunks of seqs extracted using mtp transitions
 
@@ -257,35 +527,14 @@ def chunk_sequences(seqs, mtp, mkv_thr, orders=[2, 3, 4]):
         the transitional probabilities dictionary
     orders : list
         orders in dict
+    workers : int
+        number of processes
     """
-    cl = dict()
-    # cl = set()
-    for order in orders:  # ignore 0th-order
-        cl[order] = set()
-        i = 0
-        for x in mtp[order]:
-            cks = ""
-            j = 0
-            while j < len(x):
-                if str(x[j]) == "-" or float(x[j]) >= mkv_thr:
-                    cks = cks + " " + str(seqs[i][j])
-                else:
-                    if cks != "":
-                        cks = cks.strip(" ")
-                        cl[order].add(cks)
-                        # cl.add(cks)
-                        cks = str(seqs[i][j])
-                j = j + 1
-            cks = cks.strip(" ")
-            if cks != "" and cks != " ".join(seqs[i]):  # not store the entire sequences
-                cl[order].add(cks)
-                # cl.add(cks)
-            i = i + 1
-    return cl
+    return {order: set(cnt) for order, cnt in chunk_frequencies(seqs, mtp, mkv_thr, orders, workers=workers).items()}
 
 
 # chunking sequences
-def chunk_sequences_only_sure(seqs, mtp, ord_max=6):
+def chunk_sequences_only_sure(seqs, mtp, ord_max=6, workers=1):
     """
     Returns segments/chunks of seqs extracted using mtp transitions
 
@@ -299,83 +548,97 @@ def chunk_sequences_only_sure(seqs, mtp, ord_max=6):
         the transitional probabilities dictionary
     ord_max : int
         max level/order in dict
+    workers : int
+        number of processes
+    """
+    cf = chunk_frequencies(seqs, mtp, 0.98, range(1, ord_max), only_sure=True, workers=workers)
+    return {order: set(cnt) for order, cnt in cf.items()}
+
+
+# character trie over a bag of chunks, for longest-match segmentation
+class ChunkMatcher(object):
     """
-    cl = dict()
-    # cl = set()
-    for order in range(1, ord_max):  # ignore 0th-order
-        cl[order] = set()
+    Finds the longest chunk of the bag that is a prefix of a string (as str.find(w) == 0 on the
+    chunks sorted by length, but in a single walk of the trie): two different chunks of the
+    same length can not be prefixes of the same string, so the longest match is unique.
+
+    ...
+
+    Parameters
+    ----------
+    bag : set
+        the chunks (strings of space separated symbols)
+    voc : list
+        the vocabulary, to get the index of the chunks (as voc.index)
+    """
+
+    def __init__(self, bag, voc=None):
+        # nodes are dicts: char -> child node, None -> the chunk ending at the node
+        self.root = dict()
+        for w in bag:
+            node = self.root
+            for ch in w:
+                node = node.setdefault(ch, dict())
+            node[None] = w
+        self.index = dict()
+        if voc is not None:
+            for ind, w in enumerate(voc):
+                if w in bag and w not in self.index:
+                    self.index[w] = ind
+
+    def longest(self, text, start=0):
+        """Return the longest chunk that is a prefix of text[start:], None if there is none"""
+        node = self.root
+        best = node.get(None)
+        for j in range(start, len(text)):
+            node = node.get(text[j])
+            if node is None:
+                break
+            if None in node:
+                best = node[None]
+        return best
+
+    def segment(self, sq):
+        """Return the (position, chunk or None) pairs of the left-to-right longest-match pass on sq"""
+        text = " ".join(sq)
+        res = []
         i = 0
-        for x in mtp[order]:
-            cks = ""
-            j = 0
-            while j < len(x):
-                if str(x[j]) == "-" or float(x[j]) >= 0.98:
-                    # concat new char
-                    cks = cks + " " + str(seqs[i][j])
-                else:
-                    # add founded chunk, if any
-                    if len(cks.strip(" ").split(" ")) > 1:
-                        cks = cks.strip(" ")
-                        if cks.strip(" ") == "f":
-                            print("m")
-                        cl[order].add(cks)
-                        # cl.add(cks)
-                    # start new chunk
-                    cks = str(seqs[i][j])
-                j = j + 1
-            cks = cks.strip(" ")
-            i = i + 1
-    return cl
+        offset = 0
+        while i < len(sq):
+            w = self.longest(text, offset)
+            res.append((i, w))
+            step = len(w.split(" ")) if w is not None else 1
+            for x in sq[i:i + step]:
+                offset += len(x) + 1
+            i = i + step
+        return res
 
 
 def chunk_recognition(bag, voc, sq):
     """
     Return the list of token (in bag) that match sq
+    (bag can be a ChunkMatcher built with voc)
     """
+    matcher = bag if isinstance(bag, ChunkMatcher) else ChunkMatcher(bag, voc)
     arr = []
-    # first char
-    i = 0
-    while i < len(sq):
-        search_str = " ".join(sq[i:])
-        # search search_str in words bag
-        # actually select the longer chunk that match initial position in search_str
-        ind = -1
-        # order chunks by ascending length and pick the first match
-        for w in sorted(bag, key=_key_selector):
-            if search_str.find(w) == 0:
-                ind = voc.index(w)
-        if ind > -1:
-            # match
-            match = str(ind)
-            arr.append(match)
-            i = i + len(voc[ind].split(" "))
-        else:
-            i = i + 1
+    # select the longer chunk that match each position
+    for _i, w in matcher.segment(sq):
+        if w is not None:
+            arr.append(str(matcher.index[w]) if w in matcher.index else str(voc.index(w)))
     return arr
 
 
 def chunk_segmentation(bag, pos, sq):
     """
     Return the list of token (in bag) that match sq
+    (bag can be a ChunkMatcher)
     """
+    matcher = bag if isinstance(bag, ChunkMatcher) else ChunkMatcher(bag)
     arr = []
-    # first char
-    i = 0
-    while i < len(sq):
-        search_str = " ".join(sq[i:])
-        # search search_str in words bag
-        # actually select the longer chunk that match initial position in search_str
-        ind = ""
-        # order chunks by ascending length and pick the first match
-        for w in sorted(bag, key=_key_selector):
-            if search_str.find(w) == 0:
-                ind = w
-        if ind:
-            # match
-            arr.append(ind)
-            i = i + len(ind.split(" "))
-        else:
-            i = i + 1
+    # select the longer chunk that match each position
+    for _i, w in matcher.segment(sq):
+        if w:
+            arr.append(w)
         # if search_str is not empty, detection has failed
     return arr
 
@@ -390,9 +653,13 @@ def chunks_detection(seqs, chunks_dict, write_fun=chunk_recognition):
     vocab = dict_to_vocab(chunks_dict)
     for lvl in chunks_dict.items():
         res[lvl[0]] = []
+        bag = lvl[1]
+        if write_fun in (chunk_recognition, chunk_segmentation):
+            # build the chunks trie once per level
+            bag = ChunkMatcher(bag, vocab)
         # foreach sequence
         for sq in seqs:
-            arr = write_fun(lvl[1], vocab, sq)
+            arr = write_fun(bag, vocab, sq)
             if len(arr) > 0:
                 res[lvl[0]].append(arr)
     return res
@@ -478,40 +745,135 @@ def mc_choice(arr):
     return ind
 
 
+# cumulative next-symbol distributions of a model, built lazily (per context) and sampled by binary search
+class MarkovSampler(object):
+    """
+    Draws symbols as mc_choice/mc_choice_dict do (one random.uniform(0, 1) per draw, same index for
+    the same random state), but each context's keys and cumulative probabilities are built once,
+    so a draw costs a bisection and allocates nothing.
+
+    ...
+
+    Parameters
+    ----------
+    tps : NgramTrie or dict
+        the transitional probabilities model (must not change while the sampler is in use)
+    """
+
+    def __init__(self, tps):
+        self.tps = tps
+        # order -> context -> (symbols, cumulative probabilities) or None
+        self.tables = dict()
+        self.contexts = dict()
+        # interned symbols, and tables keyed by tuples of ids: order -> ids -> table
+        self.symbols = []
+        self.ids = dict()
+        self.id_tables = dict()
+
+    def table(self, order, ctx=""):
+        """(symbols, cumulative probabilities) of the context (None if the context is missing)"""
+        tables = self.tables.get(order)
+        if tables is None:
+            tables = self.tables[order] = dict()
+        try:
+            return tables[ctx]
+        except KeyError:
+            pass
+        dist = self.tps[order] if order == 0 else self.tps[order].get(ctx)
+        res = None
+        if dist is not None:
+            cum = list(accumulate(float(v) for v in dist.values()))
+            # rounding of the total can not make a draw fall past the last symbol
+            cum[-1] = max(cum[-1], 1.0)
+            res = (list(dist.keys()), cum)
+        tables[ctx] = res
+        return res
+
+    def intern(self, sym):
+        """Return the id of the symbol"""
+        try:
+            return self.ids[sym]
+        except KeyError:
+            self.ids[sym] = len(self.symbols)
+            self.symbols.append(sym)
+            return self.ids[sym]
+
+    def table_ids(self, order, ctx):
+        """As table, with the context given as a tuple of ids"""
+        tables = self.id_tables.get(order)
+        if tables is None:
+            tables = self.id_tables[order] = dict()
+        try:
+            return tables[ctx]
+        except KeyError:
+            res = tables[ctx] = self.table(order, " ".join([self.symbols[x] for x in ctx]))
+            return res
+
+    def choice(self, order, ctx=""):
+        """Draw the next symbol of the context"""
+        return draw(self.table(order, ctx))
+
+    def random_context(self, order):
+        """A uniformly chosen context of the order, as random.choice(list(tps[order].keys()))"""
+        if order not in self.contexts:
+            self.contexts[order] = list(self.tps[order].keys())
+        return random.choice(self.contexts[order])
+
+
+# draw a symbol from a (symbols, cumulative probabilities) table,
+# random.random() is the same number as random.uniform(0, 1)
+def draw(table):
+    return table[0][bisect_left(table[1], random.random())]
+
+
+# sampler of the last model used for generation
+_sampler = None
+
+
+def model_sampler(tps):
+    global _sampler
+    if _sampler is None or _sampler.tps is not tps:
+        _sampler = MarkovSampler(tps)
+    return _sampler
+
+
+# index chosen by mc_choice, from the cumulative sums of arr
+def cum_choice(cum):
+    return min(bisect_left(cum, random.random()), len(cum) - 1)
+
+
 # from transition probabilities, generates (occ) sequences
 def generate(tps, n_seq, occ_per_seq=16):
     res = dict()
+    sampler = model_sampler(tps)
     for order in tps.keys():
         res[order] = list()
         if int(order) == 0:
             for _ns in range(0, n_seq):
                 str_res = ""
                 for _ops in range(0, occ_per_seq):
-                    idx = mc_choice(list(tps[order].values()))
-                    str_res += " " + list(tps[order].keys())[idx]
+                    str_res += " " + sampler.choice(order)
                 res[order].append(str_res.strip(" "))
         else:
             for _ns in range(0, n_seq):
                 # first choice
-                str_res = random.choice(list(tps[order].keys()))
+                str_res = sampler.random_context(order)
                 sid = str_res
                 # all other occs
                 for _ops in range(0, occ_per_seq - order):
                     #  ending symbol, no further nth-order transition
                     # cut first symbol and search for the order-1 transition
                     i = 0
-                    while i < order and (sid not in tps[order - i].keys()):
+                    table = sampler.table(order, sid)
+                    while i < order and table is None:
                         sid = " ".join(sid.split(" ")[1:])
                         i += 1
+                        table = sampler.table(order - i, sid) if i < order else None
                     if sid:
-                        val = tps[order - i][sid]
-                        idx = mc_choice(list(val.values()))
-                        str_res += " " + list(val.keys())[idx]
+                        str_res += " " + draw(table)
                     else:
                         # choose a symbol of the 0-th level
-                        idx = mc_choice(list(tps[0].values()))
-                        val = list(tps[0].keys())[idx]
-                        str_res += " " + val
+                        str_res += " " + sampler.choice(0)
 
                     sid = " ".join(str_res.split(" ")[-order:])
                 res[order].append(str_res)
@@ -521,49 +883,144 @@ def generate(tps, n_seq, occ_per_seq=16):
 # generate using n-order markov transitions and weights for markov orders
 def generate_with_weights(tps, weights, voc=None, n_seq=1, occ_per_seq=16, start_pool=None):
     res = []
+    sampler = model_sampler(tps)
+    weights_cum = list(accumulate(float(w) for w in weights))
+    max_order = len(weights) - 1
+    if start_pool:
+        start_pool = list(start_pool)
+    # number of symbols of each (translated) token, len(translate_sequence(token, voc).split(" "))
+    voc_len = dict()
+
+    def trans_len(token):
+        if not voc:
+            return 1
+        if token not in voc_len:
+            voc_len[token] = len(str(voc[int(token)]).split(" "))
+        return voc_len[token]
+
     # generate n_seq sequences
     for _ns in range(0, n_seq):
         # pick out an order
         # order = mc_choice(weights)
         # start symbol
         if start_pool:
-            str_res = random.choice(list(start_pool))
+            str_res = random.choice(start_pool)
         else:
-            str_res = mc_choice_dict(tps[0])
+            str_res = sampler.choice(0)
+        out = [str_res]
+        # the last max_order symbols (ids), and the (translated) length of the sequence
+        hist = deque((sampler.intern(x) for x in str_res.split(" ")), maxlen=max(max_order, 1))
+        length = sum(trans_len(x) for x in str_res.split(" "))
+        n_hist = len(str_res.split(" "))
         # all other symbols
         # generate occ_per_seq symbols (per sequence)
-        trans = str_res
-        if voc:
-            trans = translate_sequence(str_res, voc)
-        while len(trans.split(" ")) < occ_per_seq:
+        while length < occ_per_seq:
             # pick out the order
-            order = mc_choice(weights)
-            if order == 0:
-                # if order = 0 pick out a random symbol
-                str_res += " " + mc_choice_dict(tps[0])
+            order = cum_choice(weights_cum)
+            table = None
+            if order > 0:
+                # pick out the right history (past length due to chosen order),
+                # cut its first symbols until the context is in the model
+                ctx = tuple(hist)
+                for j in range(min(order, n_hist), 0, -1):
+                    table = sampler.table_ids(j, ctx[-j:])
+                    if table is not None:
+                        break
+            if table is not None:
+                sym = draw(table)
             else:
-                i = 0
-                # pick out the right history (past length due to chosen order)
-                sid = " ".join(str_res.split(" ")[-order:])
-                while i < order and (sid not in tps[order - i].keys()):
-                    i += 1
-                    sid = " ".join(sid.split(" ")[-(order - i):])
-                if sid and (order - i > 0):
-                    val = tps[order - i][sid]
-                    idx = mc_choice(list(val.values()))
-                    str_res += " " + list(val.keys())[idx]
-                else:
-                    # choose a symbol of the 0-th level
-                    idx = mc_choice(list(tps[0].values()))
-                    val = list(tps[0].keys())[idx]
-                    str_res += " " + val
-            trans = str_res
-            if voc:
-                trans = translate_sequence(str_res, voc)
-        res.append(str_res)
+                # if order = 0 (or no context is in the model) pick out a random symbol
+                sym = sampler.choice(0)
+            out.append(sym)
+            hist.append(sampler.intern(sym))
+            n_hist += 1
+            length += trans_len(sym)
+        res.append(" ".join(out))
     return res
 
 
+# generates many sequences at once, advancing all the chains in lockstep on the NgramTrie arrays
+class BatchGenerator(object):
+    """
+    Vectorized counterpart of generate: chains of order k start from a uniformly chosen context
+    of order k, then each next symbol is drawn from the longest suffix of the last k symbols
+    that is in the model (the 0-th order if none is). Sequences are matrices of symbol ids
+    (self.trie.symbols[id] = symbol); results are reproducible for a given seed (and batch size).
+
+    ...
+
+    Parameters
+    ----------
+    tps : NgramTrie or dict
+        the transitional probabilities model
+    seed : int or np.random.Generator
+        seed of the random generator
+    """
+
+    def __init__(self, tps, seed=None):
+        self.trie = tps if isinstance(tps, NgramTrie) else NgramTrie.from_dict(tps)
+        self.rng = np.random.default_rng(seed)
+        # contexts (nodes) of each order that have transitions
+        self.contexts = []
+        for order in range(self.trie.max_order + 1):
+            nodes = np.arange(self.trie.level_offsets[order], self.trie.level_offsets[order + 1])
+            self.contexts.append(nodes[self.trie.has_transitions(nodes)])
+
+    def _draw(self, nodes):
+        # draw the next symbol of each context node
+        edges = self.trie.sample_edges(nodes, 1.0 - self.rng.random(len(nodes)))
+        return self.trie.edge_key[edges] % self.trie.n_symbols
+
+    def _start(self, order, n_seq):
+        # uniformly chosen contexts of the order, as ids
+        nodes = self.contexts[order][self.rng.integers(0, len(self.contexts[order]), n_seq)]
+        res = np.empty((n_seq, order), dtype=np.int64)
+        for col in range(order - 1, -1, -1):
+            res[:, col] = self.trie.node_sym[nodes]
+            nodes = self.trie.node_parent[nodes]
+        return res
+
+    def sample(self, order, n_seq, occ_per_seq=16):
+        """Return a (n_seq, max(occ_per_seq, order)) matrix of sequences of the given order"""
+        order = int(order)
+        if order == 0:
+            res = np.empty((n_seq, occ_per_seq), dtype=np.int64)
+            for col in range(occ_per_seq):
+                res[:, col] = self._draw(np.zeros(n_seq, dtype=np.int64))
+            return res
+        res = np.empty((n_seq, max(occ_per_seq, order)), dtype=np.int64)
+        res[:, :order] = self._start(order, n_seq)
+        for col in range(order, occ_per_seq):
+            # back-off: cut the first symbols of the history until the context is in the model
+            nodes = np.zeros(n_seq, dtype=np.int64)
+            todo = np.arange(n_seq)
+            for i in range(order):
+                found = self.trie.find_contexts(res[todo, col - order + i:col])
+                found = np.where(self.trie.has_transitions(found), found, -1)
+                nodes[todo] = np.maximum(found, 0)
+                todo = todo[found < 0]
+                if len(todo) == 0:
+                    break
+            res[:, col] = self._draw(nodes)
+        return res
+
+    def batches(self, order, n_seq, occ_per_seq=16, batch_size=10000):
+        """Yield the n_seq sequences in matrices of at most batch_size rows"""
+        for start in range(0, n_seq, batch_size):
+            yield self.sample(order, min(batch_size, n_seq - start), occ_per_seq)
+
+    def decode(self, matrix):
+        """Convert a matrix of ids into sequences of space separated symbols"""
+        symbols = np.array(self.trie.symbols, dtype=object)
+        return [" ".join(row) for row in symbols[matrix]]
+
+
+# as generate, but returns matrices of symbol ids (see BatchGenerator)
+def generate_matrix(tps, n_seq, occ_per_seq=16, seed=None):
+    generator = BatchGenerator(tps, seed)
+    return {order: generator.sample(order, n_seq, occ_per_seq) for order in range(generator.trie.max_order + 1)}
+
+
 # convert symbols in sequences using vocabulary
 def translate(sequences, vocabulary):
     res = dict()
@@ -639,7 +1096,7 @@ def compute(seqs, dir_name="noDir", write_to_file=True):
     # compute transitions frequencies
     tf = markov_trans_freq(seqs)
     # rewrite seqs with tf
-    tf_seqs = detect_transitions(seqs, tf)
+    tf_seqs = detect_transitions(seqs, tf, numeric=True)
 
     # write
     if write_to_file:
@@ -647,19 +1104,81 @@ def compute(seqs, dir_name="noDir", write_to_file=True):
             os.mkdir(dir_name)
         with open(dir_name + "tf.json", "w") as fp:
             json.dump(tf, fp)
-        with open(dir_name + "tf_seqs.json", "w") as fp:
-            json.dump(tf_seqs, fp)
+        save_tf_seqs(dir_name + "tf_seqs.npz", tf_seqs.items())
 
     return tf, tf_seqs
 
 
+# call fun, streaming: sequences are read (more than once) from read_seqs and never held all together
+def compute_streaming(read_seqs, dir_name="noDir", order_limit=6, batch_tokens=65536):
+    """
+    Compute and write the model (tf.json, tf_seqs.npz) as compute does, with memory bounded by the model size
+    (and the tf_seqs of one batch of sequences, written to the npz as they are computed).
+    Returns tf, the alphabet and the number of tokens read.
+
+    ...
+
+    Parameters
+    ----------
+    read_seqs : function
+        returns a new iterator over the sequences (list of tokens) at each call
+    dir_name : str
+        output dir
+    order_limit : int
+        the maximum ngram length calculated
+    batch_tokens : int
+        tokens of the sequences converted to tf_seqs at a time
+    """
+    counts = [dict() for _ in range(order_limit)]
+    alphabet = set()
+    n_tokens = 0
+    seq_lengths = []
+    for arr in read_seqs():
+        arr = [str(e) for e in arr]
+        update_trans_occ(counts, arr)
+        alphabet.update(arr)
+        n_tokens += len(arr)
+        seq_lengths.append(len(arr))
+    seq_lengths = np.array(seq_lengths, dtype=np.int64)
+    tf = trans_occ_to_freq(trans_occ_to_dict(counts))
+    del counts
+
+    if not os.path.exists(dir_name):
+        os.mkdir(dir_name)
+    with open(dir_name + "tf.json", "w") as fp:
+        json.dump(tf, fp)
+    # same output as compute, one pass per order
+    trie = NgramTrie.from_dict(tf, sorted(alphabet))
+
+    # batches of sequences of about batch_tokens tokens (one long sequence is a batch)
+    def order_batches(order):
+        batch = []
+        size = 0
+        for seq in read_seqs():
+            batch.append(seq)
+            size += len(seq)
+            if size >= batch_tokens:
+                yield numeric_transitions(batch, trie, orders=[order])[order]
+                batch = []
+                size = 0
+        if batch:
+            yield numeric_transitions(batch, trie, orders=[order])[order]
+
+    # sequences too short have no transitions (empty rows)
+    save_tf_seqs_batches(dir_name + "tf_seqs.npz",
+                         ((order, np.where(seq_lengths > order, seq_lengths, 0), order_batches(order), np.float32)
+                          for order in tf.keys()))
+
+    return tf, list(alphabet), n_tokens
+
+
 # call fun for POCs
 def compute_poc(seqs, dir_name="noDir", filename="noName", write_to_file=True):
     # compute transitions frequencies
     tf = markov_trans_freq(seqs)
 
     # rewrite seqs with tf
-    tf_seqs = detect_transitions(seqs, tf)
+    tf_seqs = detect_transitions(seqs, tf, numeric=True)
     # tokenize seqs
     chunks = chunk_sequences(seqs, tf_seqs, 0.85, orders=[1, 2, 3, 4, 5])
     chunks_sure = chunk_sequences_only_sure(seqs, tf_seqs)
@@ -670,8 +1189,7 @@ def compute_poc(seqs, dir_name="noDir", filename="noName", write_to_file=True):
     if write_to_file:
         with open(dir_name + filename + "_tf.json", "w") as fp:
             json.dump(tf, fp)
-        with open(dir_name + filename + "_tf_seqs.json", "w") as fp:
-            json.dump(tf_seqs, fp)
+        save_tf_seqs(dir_name + filename + "_tf_seqs.npz", tf_seqs.items())
         with open(dir_name + filename + "_chunks.json", "w") as fp:
             json.dump(chunks, fp, default=serialize_sets)
         with open(dir_name + filename + "_chunks_sure.json", "w") as fp:
@@ -684,21 +1202,64 @@ def compute_poc(seqs, dir_name="noDir", filename="noName", write_to_file=True):
     return tf, tf_seqs, chunks, vocab, detected
 
 
-def load_model(dir_in):
+def load_model(dir_in, compact=True):
     # load models: TPs and alphabet
+    # tf.json is the import/export format, if compact the model is returned as NgramTrie,
+    # memory-mapped from the binary model tf.bin when it is up to date (else built from tf.json and tf.bin rewritten)
 
     with open(dir_in + '/model/alphabet.json') as fp:
         alph = json.load(fp)
+    if compact and binary_model_is_fresh(dir_in + '/model/'):
+        return NgramTrie.load(dir_in + '/model/tf.bin'), alph
     with open(dir_in + '/model/tf.json') as fp:
         tff = json.load(fp)
         tf = {int(k): v for k, v in tff.items()}
+    if compact:
+        tf = NgramTrie.from_dict(tf, alph)
+        # missing or stale binary model: written for the next loads
+        try:
+            tf.save(dir_in + '/model/tf.bin')
+        except OSError as e:
+            print("tf.bin not written:", e)
     return tf, alph
 
 
+# True if tf.bin exists and is not older than tf.json and alphabet.json (compute rewrites only tf.json)
+def binary_model_is_fresh(dir_name):
+    if not os.path.exists(dir_name + "tf.bin"):
+        return False
+    mtime = os.stat(dir_name + "tf.bin").st_mtime_ns
+    return all(mtime >= os.stat(dir_name + f).st_mtime_ns for f in ("tf.json", "alphabet.json")
+               if os.path.exists(dir_name + f))
+
+
+# stable identity of a model (the same model loaded again has the same fingerprint), for memos of its values
+def model_fingerprint(tps):
+    if isinstance(tps, NgramTrie):
+        return tps.fingerprint()
+    data = json.dumps({str(k): v for k, v in tps.items()}, sort_keys=True)
+    return hashlib.blake2b(data.encode(), digest_size=16).hexdigest()
+
+
+# write the binary model (tf.bin) next to tf.json
+def save_model_binary(tf, alph, dir_name):
+    NgramTrie.from_dict(tf, alph).save(dir_name + "tf.bin")
+
+
 # # for each sequence calculate markov score/support: ascending with default min value
 def sequences_markov_support_with_min_default(sequences, tps):
     _MIN = 0.0001  # minimum as a 0-like probability
     results = []
+    if isinstance(tps, NgramTrie):
+        for seq in sequences:
+            edges = tps.transition_edges(tps.encode(seq.strip(" ").split(" ")))
+            if len(edges) > 0 and edges[0] < 0:
+                raise KeyError(seq.strip(" ").split(" ")[0])
+            res = 1.0
+            for i, p in enumerate(np.where(edges >= 0, tps.edge_prob[edges], _MIN).tolist()):
+                res = p if i == 0 else res * p
+            results.append(res)
+        return results
     max_ord = max(tps.keys())
     for seq in sequences:
         arr_seq = seq.strip(" ").split(" ")
@@ -726,6 +1287,8 @@ def sequences_markov_support_with_min_default(sequences, tps):
 # for each sequence calculate "markov support" using log: ascending with default min value
 def sequences_markov_support_log(sequence, tps):
     _MIN = 0.0001  # minimum as a 0-like probability
+    if isinstance(tps, NgramTrie):
+        return _markov_support_log_trie(sequence, tps, _MIN)
     max_ord = max(tps.keys())
     arr_seq = sequence
     res = 0
@@ -748,6 +1311,95 @@ def sequences_markov_support_log(sequence, tps):
     return res
 
 
+# "markov support" using log on the compact model: same sums, the window of each position
+# (context and symbol ids) looked up in the memo of the trie
+def _markov_support_log_trie(sequence, tps, min_prob):
+    index = tps.index
+    neg_log = tps.neg_log_probs()
+    max_ord = tps.max_order
+    ids = tuple(index.get(s, -1) for s in sequence)
+    res = 0
+    for i in range(len(ids)):
+        e = tps.transition_edge(ids[max(0, i - max_ord):i + 1])
+        if i == 0:
+            if e < 0:
+                # as tps[0][ch]
+                raise KeyError(sequence[0])
+            res = float(neg_log[e])
+        elif e >= 0:
+            res += float(neg_log[e])
+        else:
+            res += - math.log(min_prob)
+    return res
+
+
+# "markov support" using log for each row of a matrix of symbol ids, in one vectorized pass
+def _markov_support_log_matrix(ids, tps, min_prob, sequences=None):
+    edges = tps.transition_edges(ids)
+    missing = np.flatnonzero(edges[:, 0] < 0)
+    if len(missing) > 0:
+        # as tps[0][ch]
+        raise KeyError(sequences[missing[0]][0] if sequences is not None else int(ids[missing[0], 0]))
+    vals = np.where(edges >= 0, tps.neg_log_probs()[edges], - math.log(min_prob))
+    # cumsum adds left to right, as the loop over positions
+    return np.cumsum(vals, axis=1)[:, -1].tolist()
+
+
+# per-position terms of sequences_markov_support_log, for the positions (rows, cols) of a matrix of ids
+def markov_support_log_terms(ids, tps, rows, cols):
+    """
+    Return the -log(p) term of each given position, the support of a sequence being the sum of its terms
+    (left to right). Each term only depends on the last max_order symbols before the position.
+
+    ...
+
+    Parameters
+    ----------
+    ids : matrix
+        2D-array of symbol ids, one sequence per row
+    tps : NgramTrie
+        the compact transitional probabilities model
+    rows, cols : array
+        the positions to score
+    """
+    _MIN = 0.0001  # minimum as a 0-like probability
+    edges = tps.transition_edges_at(ids, rows, cols)
+    missing = np.flatnonzero((edges < 0) & (np.asarray(cols) == 0))
+    if len(missing) > 0:
+        # as tps[0][ch]
+        raise KeyError(int(ids[rows[missing[0]], 0]))
+    return np.where(edges >= 0, tps.neg_log_probs()[edges], - math.log(_MIN))
+
+
+# "markov support" using log for a whole population: same values as sequences_markov_support_log
+def population_markov_support_log(population, tps):
+    """
+    Compute sequences_markov_support_log for each sequence in population.
+    With the compact model, sequences of the same length are scored together as an integer matrix.
+
+    ...
+
+    Parameters
+    ----------
+    population : list or matrix
+        a list of sequences (of symbols) or a 2D-array of symbol ids
+    tps : NgramTrie or dict
+        the transitional probabilities
+    """
+    _MIN = 0.0001  # minimum as a 0-like probability
+    if isinstance(population, np.ndarray) and population.ndim == 2:
+        if not isinstance(tps, NgramTrie):
+            raise TypeError("a matrix of symbol ids needs the compact model (NgramTrie)")
+        if population.shape[1] == 0:
+            return [0] * population.shape[0]
+        return _markov_support_log_matrix(population, tps, _MIN)
+    if not isinstance(tps, NgramTrie) or len(population) == 0 or len(set(len(x) for x in population)) > 1:
+        return [sequences_markov_support_log(x, tps) for x in population]
+    if len(population[0]) == 0:
+        return [0] * len(population)
+    return _markov_support_log_matrix(tps.encode_matrix(population), tps, _MIN, population)
+
+
 def sequences_markov_support_entropy(sequence, tps):
     _MIN = 0.0001  # minimum as a 0-like probability
     max_ord = max(tps.keys())
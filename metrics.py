@@ -1,12 +1,13 @@
 import numpy as np
 import bz2
 import textdistance
+import compression
 
 
-# NCD from NohGenerator
-def compute_ncd(a, b):
-    ca = float(len(bz2.compress(a.encode())))
-    cb = float(len(bz2.compress(b.encode())))
+# NCD from NohGenerator (compressed sizes of single strings are cached)
+def compute_ncd(a, b, cache=compression.SIZE_CACHE):
+    ca = float(cache.size(a.encode(), "bz2"))
+    cb = float(cache.size(b.encode(), "bz2"))
     cab = float(len(bz2.compress((a + b).encode())))
     return (cab - min(ca, cb)) / max(ca, cb)
 
@@ -39,6 +40,27 @@ def str_similarity(a, b):
     return textdistance.jaccard(a, b)
 
 
+# str_similarity (jaccard on multisets: sum of min counts / sum of max counts) for every pair (a in la, b in lb)
+def jaccard_matrix(la, lb, block_size=4000000):
+    symbols = dict()
+    rows = []
+    for x in list(la) + list(lb):
+        rows.append([symbols.setdefault(s, len(symbols)) for s in x])
+    counts = np.zeros((len(rows), max(1, len(symbols))), dtype=np.int64)
+    for r, ids in enumerate(rows):
+        np.add.at(counts[r], ids, 1)
+    ca = counts[:len(la)]
+    cb = counts[len(la):]
+    inter = np.zeros((len(ca), len(cb)), dtype=np.int64)
+    # rows in blocks, to bound the (rows, len(lb), symbols) temporary
+    step = max(1, block_size // max(1, cb.size))
+    for i in range(0, len(ca), step):
+        inter[i:i + step] = np.minimum(ca[i:i + step, np.newaxis, :], cb[np.newaxis, :, :]).sum(axis=2)
+    union = ca.sum(axis=1)[:, np.newaxis] + cb.sum(axis=1)[np.newaxis, :] - inter
+    # as textdistance: two empty sequences are equal (1), an empty one has similarity 0
+    return np.where(union > 0, inter / np.maximum(union, 1), 1.0)
+
+
 # similar = 0, dissimilar = 1
 def str_dissimilarity(a, b):
     return 1 - str_similarity(a,b)
@@ -0,0 +1,507 @@
+import hashlib
+import json
+import math
+import mmap
+import os
+from collections.abc import Mapping
+import numpy as np
+
+# binary model file: magic, header length (uint64), json header, arrays (aligned)
+_MAGIC = b"NGTRIE01"
+_ALIGN = 64
+_ARRAYS = ["level_offsets", "node_offsets", "node_parent", "node_sym", "search_key", "edge_prob", "edge_child",
+           "neg_log", "edge_order", "node_order"]
+_SENTINEL = np.iinfo(np.int64).max
+
+# id of unknown symbols in searches: the resulting keys (as those of missing nodes, -1) are negative and never match
+_NO_SYMBOL = -(1 << 40)
+
+# max entries of the memo of single transitions (see transition_edge)
+_MEMO_SIZE = 1 << 20
+
+
+# compact n-gram model: interned symbols and a CSR-style trie of contexts
+class NgramTrie(Mapping):
+    """
+    Array-backed transition model, equivalent to the dict-of-dicts tps.
+
+    Symbols are interned to integer ids. Every context (the last k symbols) is a trie node,
+    numbered breadth-first so that nodes of the same order are contiguous. The outgoing edges
+    of a node are stored in CSR layout and hold the next-symbol probability of that order and
+    the child node (the context extended by that symbol), if any.
+
+    ...
+
+    Attributes
+    ----------
+    symbols : list
+        the interned alphabet, symbols[id] = symbol
+    index : dict
+        symbol -> id
+    max_order : int
+        the highest order in the model
+    level_offsets : array
+        nodes of order k are in [level_offsets[k], level_offsets[k + 1])
+    node_offsets : array
+        edges of node n are in [node_offsets[n], node_offsets[n + 1])
+    node_parent, node_sym : array
+        parent node and last symbol of each node (used to decode contexts)
+    edge_key : array
+        node * n_symbols + symbol, sorted (searchable for any node)
+    edge_prob : array
+        transition probability of each edge (0.0 for path-only edges)
+    edge_child : array
+        node reached by each edge, -1 if the extended context is not in the model
+    edge_order : array
+        the edges of each node in the order of the source model (dict keys), within the node's range
+    node_order : array
+        the nodes of each order in the order of the source model (dict keys), within the order's range
+    """
+
+    def __init__(self, symbols, level_offsets, node_offsets, node_parent, node_sym,
+                 edge_key, edge_prob, edge_child, neg_log=None, edge_order=None, node_order=None):
+        self.symbols = list(symbols)
+        self.index = {s: i for i, s in enumerate(self.symbols)}
+        self.n_symbols = len(self.symbols)
+        self.max_order = len(level_offsets) - 2
+        self.level_offsets = level_offsets
+        self.node_offsets = node_offsets
+        self.node_parent = node_parent
+        self.node_sym = node_sym
+        # searchable keys with a sentinel at the end, so that searchsorted never overflows
+        # (keys read from a binary model already have it)
+        if len(edge_key) > 0 and edge_key[-1] == _SENTINEL:
+            self._search_key = edge_key
+        else:
+            self._search_key = np.append(edge_key, _SENTINEL)
+        self.edge_key = self._search_key[:-1]
+        self.edge_prob = edge_prob
+        self.edge_child = edge_child
+        # iteration order of the dict-like views (sorted ids for models without it)
+        self.edge_order = edge_order if edge_order is not None else np.arange(len(edge_prob), dtype=np.int64)
+        self.node_order = node_order if node_order is not None else np.arange(len(node_parent), dtype=np.int64)
+        self._neg_log = neg_log
+        self._memo = dict()
+        self._cum_prob = None
+        self._has_trans = None
+        self._fingerprint = None
+
+    @classmethod
+    def from_dict(cls, tps, alphabet=None):
+        """
+        Build the trie from a dict-of-dicts model (as computed by markov_trans_freq or read from tf.json).
+
+        ...
+
+        Parameters
+        ----------
+        tps : dict
+            the transitional probabilities dictionary
+        alphabet : list
+            symbols order used for the ids, symbols missing from it are appended
+        """
+        tps = {int(k): v for k, v in tps.items()}
+        max_order = max(tps.keys())
+        symbols = list(alphabet) if alphabet else []
+        index = {s: i for i, s in enumerate(symbols)}
+        for sym in tps[0].keys():
+            if sym not in index:
+                index[sym] = len(symbols)
+                symbols.append(sym)
+
+        # contexts of each order, as tuples of ids -> distribution
+        levels = [{(): tps[0]}]
+        for order in range(1, max_order + 1):
+            lvl = dict()
+            for ctx, dist in tps.get(order, {}).items():
+                lvl[tuple(index[s] for s in ctx.split(" "))] = dist
+            levels.append(lvl)
+        # every context needs its prefix as parent node (path-only if not in the model)
+        for order in range(max_order, 1, -1):
+            for ctx in list(levels[order].keys()):
+                if ctx[:-1] not in levels[order - 1]:
+                    levels[order - 1][ctx[:-1]] = None
+
+        # breadth-first numbering: sorted tuples are sorted by (parent id, symbol)
+        node_id = dict()
+        ordered = []
+        level_offsets = [0]
+        for lvl in levels:
+            for ctx in sorted(lvl.keys()):
+                node_id[ctx] = len(ordered)
+                ordered.append(ctx)
+            level_offsets.append(len(ordered))
+        # contexts in the order of the model (those added as parents last)
+        node_order = [node_id[ctx] for lvl in levels for ctx in lvl]
+        n_sym = len(symbols)
+        n_nodes = len(ordered)
+        node_parent = np.array([node_id[ctx[:-1]] if ctx else -1 for ctx in ordered], dtype=np.int32)
+        node_sym = np.array([ctx[-1] if ctx else -1 for ctx in ordered], dtype=np.int32)
+
+        # transitions of each node in the order of the model
+        edge_node = []
+        edge_sym = []
+        probs = []
+        for n, ctx in enumerate(ordered):
+            dist = levels[len(ctx)][ctx]
+            if dist:
+                edge_node.extend([n] * len(dist))
+                edge_sym.extend(index[sym] for sym in dist)
+                probs.extend(dist.values())
+        keys = np.array(edge_node, dtype=np.int64) * n_sym + np.array(edge_sym, dtype=np.int64)
+        # path-only edges towards the children without a transition
+        child_keys = node_parent[1:].astype(np.int64) * n_sym + node_sym[1:]
+        path_keys = child_keys[~np.isin(child_keys, keys)]
+        keys = np.concatenate([keys, path_keys])
+        probs = np.concatenate([np.array(probs, dtype=np.float64), np.zeros(len(path_keys))])
+
+        # edges sorted by key; edge_order lists them node by node, transitions first (model order)
+        perm = np.argsort(keys, kind="stable")
+        keys = keys[perm]
+        rank = np.empty(len(perm), dtype=np.int64)
+        rank[perm] = np.arange(len(perm))
+        edge_order = rank[np.argsort(keys[rank] // n_sym, kind="stable")] if len(perm) else rank
+        node_offsets = np.searchsorted(keys, np.arange(n_nodes + 1, dtype=np.int64) * n_sym)
+        children = np.full(len(keys), -1, dtype=np.int32)
+        children[np.searchsorted(keys, child_keys)] = np.arange(1, n_nodes, dtype=np.int32)
+
+        return cls(symbols,
+                   np.array(level_offsets, dtype=np.int64),
+                   node_offsets.astype(np.int64),
+                   node_parent,
+                   node_sym,
+                   keys,
+                   probs[perm],
+                   children,
+                   edge_order=edge_order,
+                   node_order=np.array(node_order, dtype=np.int64))
+
+    def save(self, path):
+        """
+        Write the model in binary format: a json header (alphabet, arrays layout) followed by the arrays,
+        that load maps in memory without parsing. The file is replaced atomically: processes loading
+        the model at the same time see the old file or the new one.
+        """
+        arrays = {"level_offsets": self.level_offsets, "node_offsets": self.node_offsets,
+                  "node_parent": self.node_parent, "node_sym": self.node_sym, "search_key": self._search_key,
+                  "edge_prob": self.edge_prob, "edge_child": self.edge_child, "neg_log": self.neg_log_probs(),
+                  "edge_order": self.edge_order, "node_order": self.node_order}
+        layout = dict()
+        offset = 0
+        for name in _ARRAYS:
+            arr = np.ascontiguousarray(arrays[name])
+            layout[name] = {"dtype": arr.dtype.str, "shape": list(arr.shape), "offset": offset}
+            offset += -(-arr.nbytes // _ALIGN) * _ALIGN
+        header = json.dumps({"symbols": self.symbols, "arrays": layout}).encode()
+        start = -(-(len(_MAGIC) + 8 + len(header)) // _ALIGN) * _ALIGN
+        tmp_path = path + ".tmp" + str(os.getpid())
+        with open(tmp_path, "wb") as fp:
+            fp.write(_MAGIC)
+            fp.write(np.uint64(len(header)).tobytes())
+            fp.write(header)
+            for name in _ARRAYS:
+                fp.seek(start + layout[name]["offset"])
+                fp.write(np.ascontiguousarray(arrays[name]).tobytes())
+            fp.truncate(start + offset)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Open a binary model (see save). Arrays are read-only views on a memory map of the file:
+        load time does not depend on the model size and forked processes share the pages.
+        Files written before the iteration order arrays existed are iterated in sorted order.
+        """
+        with open(path, "rb") as fp:
+            if fp.read(len(_MAGIC)) != _MAGIC:
+                raise ValueError("not a binary model: " + str(path))
+            header_len = int(np.frombuffer(fp.read(8), dtype=np.uint64)[0])
+            header = json.loads(fp.read(header_len).decode())
+            start = -(-(len(_MAGIC) + 8 + header_len) // _ALIGN) * _ALIGN
+            buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        arrays = dict()
+        for name, lay in header["arrays"].items():
+            dtype = np.dtype(lay["dtype"])
+            count = int(np.prod(lay["shape"]))
+            arrays[name] = np.frombuffer(buf, dtype=dtype, count=count, offset=start + lay["offset"])
+        return cls(header["symbols"], arrays["level_offsets"], arrays["node_offsets"], arrays["node_parent"],
+                   arrays["node_sym"], arrays["search_key"], arrays["edge_prob"], arrays["edge_child"],
+                   neg_log=arrays["neg_log"], edge_order=arrays.get("edge_order"),
+                   node_order=arrays.get("node_order"))
+
+    def to_dict(self):
+        """Export the model as dict-of-dicts (the tf.json format)"""
+        res = dict()
+        for order in range(self.max_order + 1):
+            res[order] = dict()
+            for ctx, dist in self[order].items():
+                if order == 0:
+                    res[0][ctx] = dist
+                else:
+                    res[order][ctx] = dict(dist.items())
+        return res
+
+    # -------------------------------------------------------------------------
+    # id-based access
+
+    def encode(self, sequence):
+        """Convert a list of symbols into an array of ids (-1 for unknown symbols)"""
+        return np.array([self.index.get(s, -1) for s in sequence], dtype=np.int64)
+
+    def encode_matrix(self, sequences):
+        """Convert a list of sequences of the same length into a matrix of ids (one row per sequence)"""
+        index = self.index
+        return np.array([[index.get(s, -1) for s in seq] for seq in sequences], dtype=np.int64)
+
+    def decode(self, ids):
+        """Convert a list of ids into the list of symbols"""
+        return [self.symbols[i] for i in ids]
+
+    def find_edges(self, nodes, syms):
+        """Return the edge index for each (node, symbol) pair, -1 if missing (vectorized)"""
+        nodes = np.asarray(nodes, dtype=np.int64)
+        syms = np.asarray(syms, dtype=np.int64)
+        return self._find(nodes * self.n_symbols + np.where(syms >= 0, syms, _NO_SYMBOL))
+
+    def _find(self, keys):
+        # keys of missing nodes or symbols are negative and never match
+        pos = np.searchsorted(self._search_key, keys)
+        return np.where(self._search_key[pos] == keys, pos, -1)
+
+    def context_node(self, ids):
+        """Return the node of the given context (list of ids), -1 if it is not in the model"""
+        node = 0
+        for sym in ids:
+            e = int(self.find_edges(node, sym))
+            if e < 0:
+                return -1
+            node = int(self.edge_child[e])
+            if node < 0:
+                return -1
+        return node
+
+    def transition_edge(self, ids):
+        """
+        Return the edge of the transition to ids[-1] from the context ids[:-1] (a tuple of ids),
+        -1 if it is not in the model. Results are memoized, for the scoring of single sequences.
+        """
+        try:
+            return self._memo[ids]
+        except KeyError:
+            pass
+        node = self.context_node(ids[:-1])
+        e = int(self.find_edges(node, ids[-1])) if node >= 0 else -1
+        if e >= 0 and self.edge_prob[e] <= 0:
+            e = -1
+        if len(self._memo) >= _MEMO_SIZE:
+            self._memo.clear()
+        self._memo[ids] = e
+        return e
+
+    def find_contexts(self, ids):
+        """Return the node of each row of a 2-D matrix of contexts (one per row), -1 if missing (vectorized)"""
+        ids = np.asarray(ids, dtype=np.int64)
+        ids = np.where(ids >= 0, ids, _NO_SYMBOL)
+        nodes = np.zeros(ids.shape[0], dtype=np.int64)
+        for col in range(ids.shape[1]):
+            edges = self._find(nodes * self.n_symbols + ids[:, col])
+            nodes = np.where(edges >= 0, self.edge_child[edges], -1)
+        return nodes
+
+    def has_transitions(self, nodes):
+        """Return, for each node, whether it has next-symbol probabilities (False for -1)"""
+        if self._has_trans is None:
+            pos = np.concatenate(([0], np.cumsum(self.edge_prob > 0)))
+            self._has_trans = np.append(pos[self.node_offsets[1:]] > pos[self.node_offsets[:-1]], False)
+        return self._has_trans[np.asarray(nodes, dtype=np.int64)]
+
+    def sample_edges(self, nodes, u):
+        """
+        Draw a transition from each node, by inverting the cumulative probabilities of its edges.
+
+        ...
+
+        Parameters
+        ----------
+        nodes : array
+            nodes with transitions
+        u : array
+            uniform numbers in (0, 1], one per node
+        """
+        if self._cum_prob is None:
+            self._cum_prob = np.concatenate(([0.0], np.cumsum(self.edge_prob)))
+        nodes = np.asarray(nodes, dtype=np.int64)
+        lo = self.node_offsets[nodes]
+        hi = self.node_offsets[nodes + 1]
+        base = self._cum_prob[lo]
+        edges = np.searchsorted(self._cum_prob[1:], base + u * (self._cum_prob[hi] - base))
+        return np.clip(edges, lo, hi - 1)
+
+    def context_nodes(self, ids, order=None):
+        """
+        For each position i of the sequences, return the node of the context used to score ids[..., i],
+        i.e. the last min(i, order) symbols (the root for i = 0), -1 if the context is missing.
+
+        ...
+
+        Parameters
+        ----------
+        ids : array
+            1-D sequence or 2-D matrix (one sequence per row) of symbol ids
+        order : int
+            the context length, max_order by default
+        """
+        order = self.max_order if order is None else order
+        ids = np.asarray(ids, dtype=np.int64)
+        ids = np.where(ids >= 0, ids, _NO_SYMBOL)
+        length = ids.shape[-1]
+        pos = np.arange(length)
+        iord = np.minimum(pos, order)
+        nodes = np.zeros(ids.shape, dtype=np.int64)
+        for step in range(min(order, max(length - 1, 0))):
+            # positions whose context is at least step + 1 long, walk one more symbol
+            cols = pos[iord > step]
+            edges = self._find(nodes[..., cols] * self.n_symbols + ids[..., cols - iord[cols] + step])
+            nodes[..., cols] = np.where(edges >= 0, self.edge_child[edges], -1)
+        return nodes
+
+    def transition_edges(self, ids, order=None):
+        """Return, for each position, the edge of the transition to ids[..., i] (-1 if not in the model)"""
+        ids = np.asarray(ids, dtype=np.int64)
+        edges = self._find(self.context_nodes(ids, order) * self.n_symbols + np.where(ids >= 0, ids, _NO_SYMBOL))
+        return self._transitions(edges)
+
+    def transition_edges_at(self, ids, rows, cols):
+        """
+        As transition_edges, only for the positions (rows[k], cols[k]) of a matrix of ids.
+
+        ...
+
+        Parameters
+        ----------
+        ids : matrix
+            2D-array of symbol ids, one sequence per row
+        rows, cols : array
+            the positions to look up
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        ids = np.where(ids >= 0, ids, _NO_SYMBOL)
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        iord = np.minimum(cols, self.max_order)
+        nodes = np.zeros(len(cols), dtype=np.int64)
+        for step in range(int(iord.max()) if len(iord) > 0 else 0):
+            act = np.flatnonzero(iord > step)
+            edges = self._find(nodes[act] * self.n_symbols + ids[rows[act], cols[act] - iord[act] + step])
+            nodes[act] = np.where(edges >= 0, self.edge_child[edges], -1)
+        return self._transitions(self._find(nodes * self.n_symbols + ids[rows, cols]))
+
+    def _transitions(self, edges):
+        # path-only edges are not transitions
+        valid = edges >= 0
+        valid[valid] = self.edge_prob[edges[valid]] > 0
+        return np.where(valid, edges, -1)
+
+    def fingerprint(self):
+        """
+        Return the (cached) hash of the alphabet, structure and probabilities: the same model built
+        from tf.json or loaded from tf.bin has the same fingerprint (the iteration order is not included).
+        """
+        if self._fingerprint is None:
+            h = hashlib.blake2b(json.dumps(self.symbols).encode(), digest_size=16)
+            for arr, dtype in ((self.level_offsets, np.int64), (self.node_offsets, np.int64),
+                               (self.node_parent, np.int32), (self.node_sym, np.int32), (self.edge_key, np.int64),
+                               (self.edge_prob, np.float64), (self.edge_child, np.int32)):
+                h.update(np.ascontiguousarray(arr, dtype=dtype).tobytes())
+            self._fingerprint = h.hexdigest()
+        return self._fingerprint
+
+    def neg_log_probs(self):
+        """Return the (cached) table of -log(p) for every edge"""
+        if self._neg_log is None:
+            self._neg_log = np.array([-math.log(p) if p > 0 else math.inf for p in self.edge_prob.tolist()],
+                                     dtype=np.float64)
+        return self._neg_log
+
+    def decode_context(self, node):
+        """Return the context string of the node"""
+        syms = []
+        while node > 0:
+            syms.append(self.symbols[self.node_sym[node]])
+            node = self.node_parent[node]
+        return " ".join(reversed(syms))
+
+    # -------------------------------------------------------------------------
+    # dict-like access: model[order][context][symbol], as with the dict-of-dicts tps
+
+    def __getitem__(self, order):
+        order = int(order)
+        if order < 0 or order > self.max_order:
+            raise KeyError(order)
+        if order == 0:
+            return _ContextView(self, 0)
+        return _OrderView(self, order)
+
+    def __iter__(self):
+        return iter(range(self.max_order + 1))
+
+    def __len__(self):
+        return self.max_order + 1
+
+
+# contexts of an order: context string -> _ContextView
+class _OrderView(Mapping):
+
+    def __init__(self, trie, order):
+        self.trie = trie
+        self.order = order
+
+    def _node(self, ctx):
+        if not isinstance(ctx, str):
+            raise KeyError(ctx)
+        syms = ctx.split(" ")
+        if len(syms) != self.order:
+            raise KeyError(ctx)
+        node = self.trie.context_node([self.trie.index.get(s, -1) for s in syms])
+        if node < 0 or not self._has_transitions(node):
+            raise KeyError(ctx)
+        return node
+
+    def _has_transitions(self, node):
+        trie = self.trie
+        return bool(np.any(trie.edge_prob[trie.node_offsets[node]:trie.node_offsets[node + 1]] > 0))
+
+    def __getitem__(self, ctx):
+        return _ContextView(self.trie, self._node(ctx))
+
+    def __iter__(self):
+        trie = self.trie
+        for node in trie.node_order[trie.level_offsets[self.order]:trie.level_offsets[self.order + 1]].tolist():
+            if self._has_transitions(node):
+                yield trie.decode_context(node)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+# next-symbol distribution of a context: symbol -> probability
+class _ContextView(Mapping):
+
+    def __init__(self, trie, node):
+        self.trie = trie
+        self.node = node
+
+    def __getitem__(self, sym):
+        e = int(self.trie.find_edges(self.node, self.trie.index.get(sym, -1)))
+        if e < 0 or self.trie.edge_prob[e] <= 0:
+            raise KeyError(sym)
+        return float(self.trie.edge_prob[e])
+
+    def __iter__(self):
+        trie = self.trie
+        for e in trie.edge_order[trie.node_offsets[self.node]:trie.node_offsets[self.node + 1]].tolist():
+            if trie.edge_prob[e] > 0:
+                yield trie.symbols[trie.edge_key[e] % trie.n_symbols]
+
+    def __len__(self):
+        return sum(1 for _ in self)
@@ -1,3 +1,4 @@
+import random
 import numpy as np
 from deap import creator, tools
 import constants
@@ -35,15 +36,243 @@ def novelty(individual, population, archive, dissimil_fun=metrics.str_dissimilar
     return nov
 
 
+# novelty of a list of individuals, computed together from one similarity matrix
+def novelty_population(individuals, population, archive, k=4, method="knn", archive_lengths=None,
+                       archive_removed=None):
+    """
+    Return the novelty value of each individual: the mean dissimilarity (1 - jaccard) from its neighbours
+    in (population U archive). Similarities of all the (individual, candidate) pairs are computed once,
+    as a matrix (metrics.jaccard_matrix).
+
+    ...
+
+    Parameters
+    ----------
+    individuals : list
+        the individuals to evaluate
+    population : list
+        the population (the first copy of the individual in it is not a neighbour)
+    archive : list
+        the archive
+    k : int
+        number of neighbours
+    method : str
+        "knn": the k nearest (most similar) neighbours, picked with argpartition;
+        "tournament": the current choice of novelty() (tournaments on the population then best of
+        winners + archive), same random draws and values
+    archive_lengths : list
+        for each individual, the number of archive entries (from the start) that existed when it was
+        assessed (default the whole archive)
+    archive_removed : list
+        for each archive entry, the index of the first individual that does not see it (the entry was
+        evicted while assessing it), -1 if none
+    """
+    n_pop = len(population)
+    sim = metrics.jaccard_matrix(individuals, list(population) + list(archive))
+    # the first copy of each individual in the population is excluded
+    excluded = _first_copies(individuals, population)
+    if archive_lengths is not None:
+        removed = np.asarray(archive_removed if archive_removed is not None else [-1] * len(archive), dtype=int)
+    res = []
+    for i in range(len(individuals)):
+        if archive_lengths is None:
+            members = np.arange(len(archive))
+        else:
+            removed_i = removed[:archive_lengths[i]]
+            members = np.flatnonzero((removed_i < 0) | (removed_i > i))
+        cands = np.concatenate((np.delete(np.arange(n_pop), excluded[i]) if excluded[i] >= 0 else np.arange(n_pop),
+                                n_pop + members))
+        if method == "tournament":
+            sel = _tournament_neighbours(sim[i], cands, n_pop, k)
+        else:
+            sel = cands
+            if len(cands) > k:
+                sel = cands[np.argpartition(-sim[i, cands], k - 1)[:k]]
+            # nearest first
+            sel = sel[np.argsort(-sim[i, sel], kind="stable")]
+        nov = 0
+        for j in sel:
+            nov = nov + (1 - sim[i, j])
+        res.append(float(nov / len(sel)))
+    return res
+
+
+# for each individual, index of its first copy in population (-1 if none)
+def _first_copies(individuals, population):
+    first = dict()
+    for j, x in enumerate(population):
+        first.setdefault(tuple(x), j)
+    return [first.get(tuple(x), -1) for x in individuals]
+
+
+# neighbours as chosen by select(): k tournaments (tournsize=5) on the population, then the k best
+# of winners + archive, where best is the lowest similarity (FitnessMaxTN has weight -1)
+def _tournament_neighbours(sim_row, cands, n_pop, k, tournsize=5):
+    pop_c = [j for j in cands if j < n_pop]
+    winners = []
+    for _ in range(k):
+        aspirants = [random.choice(pop_c) for _ in range(tournsize)]
+        # max fitness: first aspirant with the lowest similarity
+        winners.append(aspirants[int(np.argmin([sim_row[j] for j in aspirants]))])
+    pool = winners + [j for j in cands if j >= n_pop]
+    # selBest: stable sort by descending fitness (ascending similarity)
+    order = np.argsort([sim_row[j] for j in pool], kind="stable")
+    return [pool[j] for j in order[:k]]
+
+
 def archive_assessment(individual, evaluation, archive, dissim_fun=metrics.str_dissimilarity):
+    indexed = isinstance(archive, NoveltyArchive)
+    if indexed:
+        archive.attempts += 1
     arch_len = len(archive)
     # conditions needed to add the individual to the archive
     if evaluation > constants.NOV_FIT_THRESH:
         # if the archive has no entries or if the dissimilarity between the
         # element and the choreographies in the archive is higher than a threshold
-        # arch_dissim =
-        if arch_len == 0 or archive_dissim(individual, archive, dissimil_fun=dissim_fun) > constants.NOV_ARCH_MIN_DISS:
-            archive.append(individual)
+        if arch_len == 0:
+            arch_dissim = 1.0
+        elif indexed and dissim_fun is metrics.str_dissimilarity:
+            arch_dissim = archive.dissim(individual)
+        else:
+            arch_dissim = archive_dissim(individual, archive, dissimil_fun=dissim_fun)
+        if arch_len == 0 or arch_dissim > constants.NOV_ARCH_MIN_DISS:
+            if indexed:
+                archive.append(individual, evaluation=evaluation, novelty=arch_dissim)
+            else:
+                archive.append(individual)
+
+
+# novelty archive with a maximum capacity, eviction policies and vectorized nearest-neighbour search
+class NoveltyArchive(object):
+    """
+    Archive of individuals, used as the list archive (len, iteration, indexing, slicing).
+    When full, an admission evicts an entry according to the policy:
+    "oldest", "least_novel" (lowest dissimilarity from the archive at admission time) or
+    "lowest_fitness" (worst evaluation: the fitness is minimized, so the largest value).
+
+    The symbol counts of the entries (str_dissimilarity is computed on them) are rows of a matrix
+    grown by doubling; the row of an evicted entry is reused by the entry admitted in its place,
+    so admissions and evictions never copy the matrix. There is no index: the MAX_ARCH nearest
+    entries are found by computing the distances from all the rows at once, a vectorized scan
+    whose cost is linear in the archive size (an assessment of 50-symbol individuals takes about
+    0.1 ms with 1k entries, 1 ms with 10k). The capacity bounds it.
+
+    ...
+
+    Parameters
+    ----------
+    capacity : int
+        maximum number of entries, 0 = unbounded
+    policy : str
+        eviction policy
+    """
+
+    def __init__(self, capacity=0, policy="oldest"):
+        if policy not in ("oldest", "least_novel", "lowest_fitness"):
+            raise ValueError("invalid eviction policy: " + str(policy))
+        self.capacity = capacity
+        self.policy = policy
+        self.entries = []
+        self.evaluations = []
+        self.novelties = []
+        # row of each entry in _counts (the rows in use are [0, len(entries)))
+        self.rows = []
+        # index of the last evicted entry, when it was evicted
+        self.last_evicted = -1
+        self.symbols = dict()
+        self._counts = np.zeros((16, 16), dtype=np.int64)
+        self._sums = np.zeros(16, dtype=np.int64)
+        # counters (since the creation / since the last generation_counters call)
+        self.attempts = 0
+        self.admissions = 0
+        self.evictions = 0
+        self._last = (0, 0, 0)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __getitem__(self, item):
+        return self.entries[item]
+
+    def _count_vector(self, individual):
+        ids = [self.symbols.setdefault(s, len(self.symbols)) for s in individual]
+        if len(self.symbols) > self._counts.shape[1]:
+            # new symbols: widen the count rows
+            width = max(len(self.symbols), 2 * self._counts.shape[1])
+            self._counts = np.pad(self._counts, ((0, 0), (0, width - self._counts.shape[1])))
+        vec = np.zeros(self._counts.shape[1], dtype=np.int64)
+        np.add.at(vec, ids, 1)
+        return vec
+
+    @staticmethod
+    def _distances(vec, counts, sums=None):
+        # 1 - jaccard on multisets, as metrics.str_dissimilarity
+        inter = np.minimum(counts, vec).sum(axis=1)
+        union = vec.sum() + (counts.sum(axis=1) if sums is None else sums) - inter
+        return 1 - np.where(union > 0, inter / np.maximum(union, 1), 1.0)
+
+    def nearest(self, individual, k):
+        """Return the k smallest str_dissimilarity values between individual and the entries, ascending"""
+        vec = self._count_vector(individual)
+        n = len(self.entries)
+        k = min(k, n)
+        dist = self._distances(vec, self._counts[:n], self._sums[:n])
+        if k < n:
+            dist = np.partition(dist, k - 1)[:k]
+        return np.sort(dist)
+
+    def dissim(self, individual):
+        """archive_dissim of the individual with str_dissimilarity"""
+        values = self.nearest(individual, constants.MAX_ARCH)
+        dissimilarity = 0
+        for v in values.tolist():
+            dissimilarity = dissimilarity + v
+        return dissimilarity / len(values)
+
+    def append(self, individual, evaluation=None, novelty=1.0):
+        """Add the individual (evicting an entry if the archive is full)"""
+        vec = self._count_vector(individual)
+        if self.capacity and len(self.entries) >= self.capacity:
+            row = self._evict()
+        else:
+            row = len(self.entries)
+            if row == len(self._counts):
+                self._counts = np.pad(self._counts, ((0, row), (0, 0)))
+                self._sums = np.pad(self._sums, (0, row))
+        self._counts[row] = vec
+        self._sums[row] = vec.sum()
+        self.entries.append(individual)
+        self.evaluations.append(evaluation)
+        self.novelties.append(novelty)
+        self.rows.append(row)
+        self.admissions += 1
+
+    def _evict(self):
+        # remove an entry, return its row (free for the next one)
+        if self.policy == "least_novel":
+            i = int(np.argmin(self.novelties))
+        elif self.policy == "lowest_fitness":
+            i = int(np.argmax([-np.inf if e is None else e for e in self.evaluations]))
+        else:
+            i = 0
+        del self.entries[i]
+        del self.evaluations[i]
+        del self.novelties[i]
+        self.evictions += 1
+        self.last_evicted = i
+        return self.rows.pop(i)
+
+    def generation_counters(self):
+        """Return size and counters since the last call (admission rate = admissions / assessments)"""
+        attempts = self.attempts - self._last[0]
+        admissions = self.admissions - self._last[1]
+        evictions = self.evictions - self._last[2]
+        self._last = (self.attempts, self.admissions, self.evictions)
+        return {"size": len(self.entries), "assessments": attempts, "admissions": admissions,
+                "evictions": evictions, "admission_rate": admissions / attempts if attempts else 0.0}
 
 ########################################################################
 # novelty on phenotype
@@ -0,0 +1,109 @@
+import time
+
+# phases of a generation of run_ga, in order
+PHASES = ["evaluation", "selection", "cloning", "crossover", "mutation", "reevaluation", "migration", "stats"]
+# phases timed inside evaluation and reevaluation (when novelty is on)
+SUB_PHASES = ["fitness", "archive_assessment", "novelty"]
+
+
+# context manager timing one phase
+class _Phase(object):
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timer.add(self.name, time.perf_counter() - self.start)
+        return False
+
+
+# context manager of a disabled timer
+class _NoPhase(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_PHASE = _NoPhase()
+
+
+# wall time of the phases of each generation, and counters
+class PhaseTimer(object):
+    """
+    Accumulates the seconds spent in each phase and named counters, for the current generation
+    and for the whole run. A disabled timer does nothing: phase() returns a shared no-op context
+    and add/count return at once.
+
+    ...
+
+    Parameters
+    ----------
+    enabled : bool
+        if False, nothing is measured
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.seconds = dict()
+        self.counters = dict()
+        self.total_seconds = dict()
+        self.total_counters = dict()
+        self.generations = 0
+
+    def phase(self, name):
+        """Context manager adding its wall time to phase name"""
+        if not self.enabled:
+            return _NO_PHASE
+        return _Phase(self, name)
+
+    def add(self, name, seconds):
+        if not self.enabled:
+            return
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def end_generation(self):
+        """Return {"seconds": ..., "counters": ...} of the generation and start the next one"""
+        res = {"seconds": self.seconds, "counters": self.counters}
+        for k, v in self.seconds.items():
+            self.total_seconds[k] = self.total_seconds.get(k, 0.0) + v
+        for k, v in self.counters.items():
+            self.total_counters[k] = self.total_counters.get(k, 0) + v
+        self.seconds = dict()
+        self.counters = dict()
+        self.generations += 1
+        return res
+
+    def totals(self):
+        return {"generations": self.generations, "seconds": self.total_seconds, "counters": self.total_counters}
+
+    def summary(self):
+        """Table of the total and mean seconds of each phase, with its share of the generations time, and counters"""
+        total = sum(self.total_seconds.get(p, 0.0) for p in PHASES)
+        n = max(1, self.generations)
+        lines = ["%-22s %12s %12s %8s" % ("phase", "total s", "s / gen", "%")]
+        names = [p for p in PHASES if p in self.total_seconds]
+        names += ["  " + p for p in SUB_PHASES if p in self.total_seconds]
+        names += [p for p in self.total_seconds if p not in PHASES and p not in SUB_PHASES]
+        for name in names:
+            s = self.total_seconds[name.strip()]
+            lines.append("%-22s %12.4f %12.6f %7.1f%%" % (name, s, s / n, 100.0 * s / total if total else 0.0))
+        lines.append("%-22s %12.4f %12.6f" % ("generations", total, total / n))
+        if self.total_counters:
+            lines.append("")
+            lines.append("%-22s %12s %12s" % ("counter", "total", "/ gen"))
+            for name, v in self.total_counters.items():
+                lines.append("%-22s %12d %12.1f" % (name, v, v / n))
+        return "\n".join(lines)
@@ -19,9 +19,16 @@ def plot_tps(dir_out, tf_seqs, file_name=""):
         axes[i % 2][j % 3].set_yticks(np.arange(start=0, stop=1.1, step=0.1))
         axes[i % 2][j % 3].label_outer()
         for ln in itm[1]:
+            if isinstance(ln, np.ndarray):
+                # numeric tf_seqs: NaN where there is no transition, and as padding
+                tps = np.flatnonzero(~np.isnan(ln))
+                ln = ln[:tps[-1] + 1] if len(tps) > 0 else ln[:0]
             if len(ln) > 0:
                 axes[i % 2][j % 3].axis([0,len(ln), 0.0, 1.1])
-                vl = [round(x,2) if x != "-" else 0 for x in ln]
+                if isinstance(ln, np.ndarray):
+                    vl = np.where(np.isnan(ln), 0, np.round(ln, 2))
+                else:
+                    vl = [round(x,2) if x != "-" else 0 for x in ln]
                 axes[i % 2][j % 3].plot(range(0,len(ln)),vl)
     # fig.tight_layout()
     # plt.show()
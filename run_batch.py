@@ -1,48 +1,177 @@
 """
 Runs multiple GAs on params values
 """
-from datetime import datetime
-import generate_models
-from main import run_ga
+import glob
+import json
 import multiprocessing as mp
+import os
+import sys
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from multiprocessing.connection import wait
+import generate_models
+import main as ga
+import run_log
+
+# attempts of a failed task after the first one, and seconds before each of them
+RETRIES = 2
+RETRY_DELAY = 2.0
+
+
+# run dirs of a GA job (data/out/<file>/<method>_<seed>_<date>/): completed ones and resumable ones
+def find_runs(file_name, random_seed, novelty_method):
+    done = []
+    resumable = []
+    pattern = "data/out/" + glob.escape(file_name) + "/" + glob.escape(novelty_method) + "_" + str(random_seed) + "_*/"
+    for d in sorted(glob.glob(pattern)):
+        if os.path.exists(d + "run_log.jsonl") and run_log.is_complete(d + "run_log.jsonl"):
+            done.append(d)
+        elif os.path.exists(d + "checkpoint.pkl"):
+            resumable.append(d)
+    return done, resumable
+
+
+# GA job: continue the last interrupted run of the job if it has a checkpoint, else run it from scratch
+def _run_job(file_name, random_seed, novelty_method):
+    _done, resumable = find_runs(file_name, random_seed, novelty_method)
+    if resumable:
+        ga.resume_ga(resumable[-1])
+    elif ga.run_ga(file_name, random_seed, novelty_method) == 0:
+        raise RuntimeError("no model for " + file_name)
+
 
+# child process: fun(*args) with stdout and stderr appended to log_path (an exception exits with code 1)
+def _run_task(fun, args, log_path):
+    fp = open(log_path, "a", buffering=1)
+    os.dup2(fp.fileno(), 1)
+    os.dup2(fp.fileno(), 2)
+    sys.stdout = sys.stderr = fp
+    print("#", datetime.now().isoformat(timespec="seconds"), fun.__name__, args)
+    fun(*args)
+    fp.flush()
 
-def _apply_fun(x):
-    # fname, ranseed, novmeth
-    run_ga(x[0], x[1], x[2])
 
+def schedule(tasks, workers, log_dir, retries=RETRIES):
+    """
+    Run each task in its own process, at most workers at a time, so a failing (or crashing) task
+    does not stop the others. Failed tasks are retried up to retries times. The output of a task goes
+    to log_dir/<name>.log; progress and ETA are printed as tasks end.
 
-def main():
-    data = []
-    pool = mp.Pool(mp.cpu_count()-1)
+    ...
+
+    Parameters
+    ----------
+    tasks : list
+        (name, fun, args) of the tasks, fun must be a module function
+    workers : int
+        number of tasks running together
+    log_dir : str
+        dir of the tasks logs
+    retries : int
+        attempts of a failed task after the first one
+
+    Returns
+    -------
+    dict
+        name -> {"ok": bool, "attempts": int, "seconds": float, "log": str}
+    """
+    os.makedirs(log_dir, exist_ok=True)
+    # (name, fun, args, attempt, not before)
+    pending = deque((name, fun, args, 1, 0.0) for name, fun, args in tasks)
+    running = dict()
+    results = dict()
+    start = time.time()
+    while pending or running:
+        # start the ready tasks on the free slots
+        waiting = deque()
+        while pending and len(running) < workers:
+            task = pending.popleft()
+            if task[4] > time.time():
+                waiting.append(task)
+                continue
+            name, fun, args = task[:3]
+            p = mp.Process(target=_run_task, args=(fun, args, log_dir + name + ".log"))
+            p.start()
+            running[p.sentinel] = (p, task, time.time())
+        pending.extendleft(reversed(waiting))
+        if not running:
+            time.sleep(max(0.0, min(t[4] for t in pending) - time.time()))
+            continue
+        for sentinel in wait(list(running), timeout=RETRY_DELAY):
+            p, (name, fun, args, attempt, _t), t_start = running.pop(sentinel)
+            p.join()
+            seconds = time.time() - t_start
+            if p.exitcode != 0 and attempt <= retries:
+                print("  retry", name, "(exit code " + str(p.exitcode) + ", attempt " + str(attempt) + ")")
+                pending.append((name, fun, args, attempt + 1, time.time() + RETRY_DELAY))
+                continue
+            results[name] = {"ok": p.exitcode == 0, "attempts": attempt, "seconds": seconds,
+                             "log": log_dir + name + ".log"}
+            elapsed = time.time() - start
+            eta = elapsed / len(results) * (len(tasks) - len(results))
+            print("[" + str(len(results)) + "/" + str(len(tasks)) + "]", "ok    " if p.exitcode == 0 else "FAILED",
+                  name, "(" + str(round(seconds, 1)) + "s)", "elapsed", timedelta(seconds=round(elapsed)),
+                  "ETA", timedelta(seconds=round(eta)))
+            sys.stdout.flush()
+    return results
+
+
+def main(files=None, seeds=None, methods=None, workers=None, retries=RETRIES):
     start_time = datetime.now()
 
-    seeds = [7]
-    methods = ["multi_log_genotype"]
-    files = [
-        # {"name": "input", "sep": ""},
-        # {"name": "input2", "sep": ""},
-        {"name": "irish", "sep": " "},
-        {"name": "bicinia", "sep": " "},
-        {"name": "all_irish-notes_and_durations-abc", "sep": " "},
-        # {"name": "all_songs_in_G", "sep": ""}, # generated only for seed = 7
-    ]
-
-    # file name and separator
+    if seeds is None:
+        seeds = [7]
+    if methods is None:
+        methods = ["multi_log_genotype"]
+    if files is None:
+        files = [
+            # {"name": "input", "sep": ""},
+            # {"name": "input2", "sep": ""},
+            {"name": "irish", "sep": " "},
+            {"name": "bicinia", "sep": " "},
+            {"name": "all_irish-notes_and_durations-abc", "sep": " "},
+            # {"name": "all_songs_in_G", "sep": ""}, # generated only for seed = 7
+        ]
+    if workers is None:
+        workers = max(1, mp.cpu_count() - 1)
+    log_dir = "data/out/batch_" + start_time.strftime("%Y%m%d-%H.%M.%S") + "/"
+
+    # markov models: one per corpus (they do not depend on the seed), only the missing ones
+    models = dict((fl["name"], fl["sep"]) for fl in files)
+    tasks = [("model_" + name, generate_models.create, (name, sep)) for name, sep in models.items()
+             if not generate_models.model_exists(name)]
+    print("models:", len(models), "to build:", len(tasks))
+    results = schedule(tasks, workers, log_dir, retries)
+    missing = set(name for name in models if not generate_models.model_exists(name))
+
+    # GA jobs, skipping the ones with results (file name, seed for random, novelty method)
+    tasks = []
+    skipped = 0
+    no_model = 0
     for fl in files:
-        # seed for random
         for rs in seeds:
-            # generate markov model
-            generate_models.create(fl["name"], fl["sep"], rs)
-
             for nov_method in methods:
-                data.append([fl["name"], rs, nov_method])
-    #
-    # # multiprocessing
-    pool.map(_apply_fun, data)
-    pool.close()
-    pool.join()
+                name = fl["name"] + "_" + nov_method + "_" + str(rs)
+                if find_runs(fl["name"], rs, nov_method)[0]:
+                    skipped += 1
+                elif fl["name"] in missing:
+                    no_model += 1
+                    results[name] = {"ok": False, "attempts": 0, "seconds": 0.0, "log": None}
+                else:
+                    tasks.append((name, _run_job, (fl["name"], rs, nov_method)))
+    print("jobs:", len(tasks) + skipped + no_model, "with results:", skipped, "without model:", no_model,
+          "to run:", len(tasks))
+    results.update(schedule(tasks, workers, log_dir, retries))
+
+    failed = sorted(name for name, res in results.items() if not res["ok"])
+    if results:
+        with open(log_dir + "summary.json", "w") as fp:
+            json.dump(results, fp, indent=1)
     print("batch time elapsed :", (datetime.now() - start_time).total_seconds(), "sec.")
+    if failed:
+        print("failed:", ", ".join(failed))
+    return results
 
 
 if __name__ == "__main__":
@@ -0,0 +1,127 @@
+import json
+import os
+import markov
+
+
+# append-only log of a GA run, one JSON object per line
+class RunLog(object):
+    """
+    Writes a run as it goes: a header record, one record per generation (flushed when written)
+    and an end record, so memory does not grow with the generations and a crash loses at most
+    the generation being written. The archive is delta-encoded: each generation stores the
+    positions of the entries removed since the previous one and the entries added.
+
+    ...
+
+    Parameters
+    ----------
+    path : str
+        the log file (JSONL), opened in append mode
+    size : int
+        when resuming a run, the size of the log at the checkpoint (later records are discarded)
+    archive : NoveltyArchive or list
+        when resuming a run, the archive at the checkpoint
+    """
+
+    def __init__(self, path, size=None, archive=None):
+        self.path = path
+        if size is not None:
+            with open(path, "r+") as fp:
+                fp.truncate(size)
+        self.fp = open(path, "a")
+        # entries of the archive at the last logged generation (references)
+        self._archive = list(archive) if archive is not None else []
+
+    def write(self, record):
+        self.fp.write(json.dumps(record, default=markov.serialize_sets) + "\n")
+        self.fp.flush()
+
+    def archive_delta(self, archive):
+        """Return (positions of the removed entries, added entries) since the last call"""
+        current = list(archive)
+        # entries are only removed or appended: walk both lists keeping the common entries
+        deleted = []
+        j = 0
+        for i, x in enumerate(self._archive):
+            if j < len(current) and current[j] is x:
+                j += 1
+            else:
+                deleted.append(i)
+        self._archive = current
+        return deleted, current[j:]
+
+    def generation(self, g, method, pop, fitness, archive, archive_counters, **kwargs):
+        """Append the record of generation g"""
+        deleted, added = self.archive_delta(archive)
+        record = {"g": g, "method": method, "pop": pop, "fitness": fitness,
+                  "archive_del": deleted, "archive_add": added, "archive_counters": archive_counters}
+        record.update(kwargs)
+        self.write(record)
+
+    def size(self):
+        """Size of the log written so far"""
+        return self.fp.tell()
+
+    def close(self):
+        self.fp.close()
+
+
+# True if the log ends with the end record of the run (the last line, read from the end of the file)
+def is_complete(path, tail_size=65536):
+    with open(path, "rb") as fp:
+        fp.seek(0, os.SEEK_END)
+        fp.seek(max(0, fp.tell() - tail_size))
+        tail = fp.read()
+    if not tail.endswith(b"\n"):
+        return False
+    try:
+        record = json.loads(tail[:-1].rsplit(b"\n", 1)[-1])
+    except ValueError:
+        return False
+    return "g" not in record and "time" in record
+
+
+# read the records of a run log (a truncated last line, left by a crash, is ignored)
+def iter_records(path):
+    with open(path) as fp:
+        for line in fp:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                return
+
+
+# iterate over (key, value) pairs of the stats structure, with the archive of each generation rebuilt
+def iter_stats(path):
+    archive = []
+    for record in iter_records(path):
+        if "g" not in record:
+            for item in record.items():
+                yield item
+            continue
+        page = dict()
+        for k, v in record.items():
+            if k == "archive_del":
+                deleted = set(v)
+                archive = [x for i, x in enumerate(archive) if i not in deleted] + record["archive_add"]
+                page["archive"] = archive
+            elif k not in ("g", "archive_add"):
+                page[k] = v
+        yield str(record["g"]), page
+
+
+def read_stats(path):
+    """
+    Rebuild the stats structure of a run from its log, as it was read from stats.json
+    (generations keys are strings)
+    """
+    return dict(iter_stats(path))
+
+
+def write_stats_json(path, json_path):
+    """Write the stats.json of a run from its log, one generation at a time"""
+    with open(json_path, "w") as fp:
+        fp.write("{")
+        for i, (k, v) in enumerate(iter_stats(path)):
+            fp.write((", " if i > 0 else "") + json.dumps(k) + ": " + json.dumps(v))
+        fp.write("}")
@@ -9,104 +9,255 @@
 # aaabbbbc
 
 
-import bz2
 import math
+import multiprocessing as mp
 import optparse
 import sys
-import zlib
+import time
+from statistics import NormalDist
+import numpy as np
+import compression
 
+# side of the square tiles of pairs compressed by one task
+TILE_SIZE = 64
 
-def compute_sbc(file_name):
+
+# compute a tile of the (upper triangular) ncd matrix, rows and cols are (offset, data, sizes)
+def _ncd_tile(args):
+    compressor, level, rows, cols = args
+    i0, row_data, row_sizes = rows
+    j0, col_data, col_sizes = cols
+    res = np.full((len(row_data), len(col_data)), np.nan)
+    for r, (a, ca) in enumerate(zip(row_data, row_sizes)):
+        for c, (b, cb) in enumerate(zip(col_data, col_sizes)):
+            if j0 + c < i0 + r:
+                continue
+            cab = float(len(compression.compress(a + b, compressor, level)))
+            res[r, c] = 1 - (cab - min(ca, cb)) / max(ca, cb)
+    return i0, j0, res
+
+
+# ncd similarities of a list of pairs (a, b, size of a, size of b)
+def _ncd_pairs(args):
+    compressor, level, pairs = args
+    res = []
+    for a, b, ca, cb in pairs:
+        cab = float(len(compression.compress(a + b, compressor, level)))
+        res.append(1 - (cab - min(ca, cb)) / max(ca, cb))
+    return res
+
+
+def read_lines(file_name):
     res = []
-    count = 0
     with open(file_name, "r") as fp:
         for line in fp:
             res.append(line.replace('\n', '').encode())
-            count += 1
+    return res
+
+
+def compute_sbc(file_name, workers=1):
+    res = read_lines(file_name)
+    count = len(res)
     if count > 1:
-        sbc = SBC("bz2", "9", res)
+        sbc = SBC("bz2", "9", res, workers=workers)
         return sbc.compute()
     else:
         print("(SBC, path excluded): " + file_name)
         return -1
 
 
-def compute_sbc_from_pop(pop):
+def compute_sbc_from_pop(pop, workers=1):
     pop_list = []
     count = 0
     for ind in pop:
         pop_list.append("".join(ind).encode())
         count += 1
     if count > 1:
-        sbc = SBC("bz2", "9", pop_list)
+        sbc = SBC("bz2", "9", pop_list, workers=workers)
         return sbc.compute()
     else:
         print("(SBC, pop excluded): " + str(pop_list))
         return -1
 
 
+def estimate_sbc(file_name, workers=1, **kwargs):
+    res = read_lines(file_name)
+    if len(res) > 1:
+        return SBC("bz2", "9", res, workers=workers).estimate(**kwargs)
+    else:
+        print("(SBC, path excluded): " + file_name)
+        return -1, (-1, -1)
+
+
+def estimate_sbc_from_pop(pop, workers=1, **kwargs):
+    pop_list = ["".join(ind).encode() for ind in pop]
+    if len(pop_list) > 1:
+        return SBC("bz2", "9", pop_list, workers=workers).estimate(**kwargs)
+    else:
+        print("(SBC, pop excluded): " + str(pop_list))
+        return -1, (-1, -1)
+
+
 # class SBC
 class SBC(object):
 
-    def __init__(self, compressor, level, data):
+    def __init__(self, compressor, level, data, cache=compression.SIZE_CACHE, workers=1):
         self.data = data
         self.n = len(data)
-        if compressor == 'zlib':
-            self.compress = zlib.compress
-        elif compressor == 'bz2':
-            self.compress = bz2.compress
-        else:
+        if compressor not in ('zlib', 'bz2'):
             sys.stderr.write('invalid compressor\n')
             sys.exit(1)
+        self.compressor = compressor
+        self.level = int(level)
+        # compressed sizes of single strings, shared with metrics.compute_ncd
+        self.cache = cache
+        # number of processes compressing the pairs of strings
+        self.workers = max(1, workers)
+
+    def compress(self, x):
+        return compression.compress(x, self.compressor, self.level)
+
+    def compressed_size(self, x):
+        return self.cache.size(x, self.compressor, self.level)
 
     def compute_all_kappa(self):
-        self.kappa = []
-        for x in self.data:
-            result = float(len(self.compress(x)))
-            l = len(set(x))  # count number of unique chars
-            result = result / math.log(l, 2)  # weight with max entropy
-            self.kappa.append(result)
+        self.sizes = np.array([float(self.compressed_size(x)) for x in self.data])
+        # weight with max entropy (log2 of the number of unique chars)
+        self.kappa = self.sizes / np.array([math.log(len(set(x)), 2) for x in self.data])
 
     def compute_ncd(self, a, b):
-        ca = float(len(self.compress(a)))
-        cb = float(len(self.compress(b)))
+        ca = float(self.compressed_size(a))
+        cb = float(self.compressed_size(b))
         cab = float(len(self.compress(a + b)))
         return 1 - (cab - min(ca, cb)) / max(ca, cb)
 
     def compute_all_ncd(self):
-        m = []
-        for i in range(self.n):
-            maux = []
-            for j in range(i, self.n):
-                maux.append(self.compute_ncd(self.data[i], self.data[j]))
-            m.append(maux)
+        """
+        Fill the symmetric n x n matrix of ncd similarities, self.ncd[i, j] = compute_ncd(data[i], data[j])
+        for i <= j. The upper triangle is split in square tiles, compressed on a pool of
+        self.workers processes (serially if workers == 1), and mirrored to the lower one.
+        """
+        blocks = [(i, self.data[i:i + TILE_SIZE], self.sizes[i:i + TILE_SIZE]) for i in range(0, self.n, TILE_SIZE)]
+        tasks = [(self.compressor, self.level, rows, cols)
+                 for x, rows in enumerate(blocks) for cols in blocks[x:]]
+        if self.workers > 1 and len(tasks) > 1:
+            with mp.Pool(min(self.workers, len(tasks))) as pool:
+                tiles = pool.map(_ncd_tile, tasks)
+        else:
+            tiles = map(_ncd_tile, tasks)
+        m = np.empty((self.n, self.n))
+        for i0, j0, tile in tiles:
+            m[i0:i0 + tile.shape[0], j0:j0 + tile.shape[1]] = tile
+        iu = np.triu_indices(self.n, 1)
+        m[iu[1], iu[0]] = m[iu]
         self.ncd = m
 
     def compute_all_effe(self):
         self.xi = 2.0 / (self.n * (self.n - 1))
-        self.effe = []
-        for i in range(self.n):
-            s = 0.0
-            # a,b -> m[a][b-a], if a <= b
-            #     -> m[b][a-b], if a > b
-            for j in range(i + 1, self.n):  # true matrix indices!
-                s = s + self.ncd[i][j - i] * (1 - self.ncd[i][j - i])
-            for j in range(0, i):  # true matrix indices!
-                s = s + self.ncd[j][i - j] * (1 - self.ncd[j][i - j])
-            s = s * self.xi
-            self.effe.append(s)
+        self.effe = np.empty(self.n)
+        # row i is summed over j = i+1, ..., n-1, 0, ..., i-1 (as in the triangular layout),
+        # by blocks of rows to bound the memory
+        t = np.arange(self.n - 1)
+        for i0 in range(0, self.n, TILE_SIZE):
+            rows = np.arange(i0, min(i0 + TILE_SIZE, self.n))
+            cols = (rows[:, None] + 1 + t) % self.n
+            v = self.ncd[rows[:, None], cols]
+            self.effe[rows] = np.cumsum(v * (1 - v), axis=1)[:, -1] * self.xi
 
     def compute(self):
+        hits, misses = self.cache.hits, self.cache.misses
         self.compute_all_kappa()
         self.compute_all_ncd()
         self.compute_all_effe()
         xi = 1.0 / self.n
-        s = 0.0
-        for i in range(self.n):
-            s = s + self.kappa[i] * self.effe[i]
-        s = xi * s
+        s = xi * float(np.cumsum(self.kappa * self.effe)[-1])
+        # compressed sizes cache use during this computation
+        hits, misses = self.cache.hits - hits, self.cache.misses - misses
+        self.cache_stats = {"hits": hits, "misses": misses, "hit_rate": hits / (hits + misses) if hits else 0.0}
         return s
 
+    def estimate(self, pairs_per_element=32, max_pairs=None, max_seconds=None, confidence=0.95, seed=None):
+        """
+        Approximate SBC from a random sample of pairs per element.
+        Since effe_i = 2/n * mean_{j != i} ncd_ij * (1 - ncd_ij), each round draws one partner j != i
+        (with replacement) for every element i and updates the sample mean of effe_i. Sampling stops
+        after pairs_per_element rounds, or when max_pairs compressions or max_seconds are spent
+        (budgets are checked after each round, at least 2 rounds are made).
+        The interval is a normal approximation that treats the elements' samples as independent.
+
+        ...
+
+        Parameters
+        ----------
+        pairs_per_element : int
+            maximum number of sampled partners of each element
+        max_pairs : int
+            budget of pair compressions
+        max_seconds : float
+            budget of time
+        confidence : float
+            level of the confidence interval
+        seed : int or np.random.Generator
+            seed of the random generator
+
+        Returns
+        -------
+        tuple
+            (estimate, (low, high)), details are stored in self.estimate_stats
+        """
+        start = time.time()
+        rng = np.random.default_rng(seed)
+        self.compute_all_kappa()
+        # sums of ncd * (1 - ncd) over the sampled partners, and of their squares
+        s1 = np.zeros(self.n)
+        s2 = np.zeros(self.n)
+        memo = {}
+        pairs = 0
+        rounds = 0
+        idx = np.arange(self.n)
+        pool = mp.Pool(self.workers) if self.workers > 1 else None
+        try:
+            while rounds < max(2, pairs_per_element):
+                partners = (idx + 1 + rng.integers(0, self.n - 1, self.n)) % self.n
+                keys = list(zip(np.minimum(idx, partners).tolist(), np.maximum(idx, partners).tolist()))
+                todo = list({k: None for k in keys if k not in memo})
+                items = [(self.data[a], self.data[b], self.sizes[a], self.sizes[b]) for a, b in todo]
+                if pool is not None:
+                    step = -(-len(items) // self.workers)
+                    chunks = [(self.compressor, self.level, items[x:x + step]) for x in range(0, len(items), step)]
+                    values = [v for res in pool.map(_ncd_pairs, chunks) for v in res]
+                else:
+                    values = _ncd_pairs((self.compressor, self.level, items))
+                memo.update(zip(todo, values))
+                pairs += len(todo)
+                rounds += 1
+                v = np.array([memo[k] for k in keys])
+                v = v * (1 - v)
+                s1 += v
+                s2 += v * v
+                if rounds >= 2 and ((max_pairs is not None and pairs >= max_pairs) or
+                                    (max_seconds is not None and time.time() - start >= max_seconds)):
+                    break
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        mean = s1 / rounds
+        var = np.maximum(s2 - rounds * mean * mean, 0.0) / (rounds - 1)
+        scale = 2.0 / (self.n * self.n)
+        est = scale * float(np.sum(self.kappa * mean))
+        half = NormalDist().inv_cdf(0.5 + confidence / 2) * scale * math.sqrt(float(np.sum(self.kappa ** 2 * var)) / rounds)
+        self.estimate_stats = {"rounds": rounds, "pairs": pairs, "all_pairs": self.n * (self.n - 1) // 2,
+                               "seconds": time.time() - start}
+        return est, (est - half, est + half)
+
+    def validate(self, **kwargs):
+        """Compare estimate(**kwargs) with the exact compute(), meant for small inputs"""
+        est, (low, high) = self.estimate(**kwargs)
+        exact = self.compute()
+        return {"exact": exact, "estimate": est, "low": low, "high": high, "covered": low <= exact <= high,
+                "rel_error": abs(est - exact) / exact if exact else 0.0}
+
 
 # main
 def main():
@@ -114,6 +265,14 @@ def main():
     opt.add_option('-c', dest='compressor', default='zlib', choices=('zlib', 'bz2'),
                    help='compressor algorithm (zlib,bz2)')
     opt.add_option('-l', dest='level', default='9', choices=map(str, range(1, 10)), help='compression level (1-9)')
+    opt.add_option('-j', dest='workers', default=1, type='int', help='number of worker processes')
+    opt.add_option('-a', dest='approx', action='store_true', default=False, help='estimate SBC from sampled pairs')
+    opt.add_option('-p', dest='pairs', default=32, type='int', help='sampled pairs per element (with -a)')
+    opt.add_option('-b', dest='max_pairs', default=None, type='int', help='budget of pair compressions (with -a)')
+    opt.add_option('-t', dest='max_seconds', default=None, type='float', help='budget of seconds (with -a)')
+    opt.add_option('-s', dest='seed', default=None, type='int', help='random seed (with -a)')
+    opt.add_option('-v', dest='validate', action='store_true', default=False,
+                   help='compare the estimate with the exact SBC')
     (options, files) = opt.parse_args()
 
     data = []
@@ -122,11 +281,20 @@ def main():
     for line in f.readlines():
         data.append(line.rstrip())
 
-    sbc = SBC(options.compressor, options.level, data)
+    sbc = SBC(options.compressor, options.level, data, workers=options.workers)
 
     # print sbc.comp()
     # print sbc.ncd_matrix()
-    print(sbc.compute())
+    kwargs = {"pairs_per_element": options.pairs, "max_pairs": options.max_pairs,
+              "max_seconds": options.max_seconds, "seed": options.seed}
+    if options.validate:
+        print(sbc.validate(**kwargs))
+    elif options.approx:
+        print(sbc.estimate(**kwargs))
+        sys.stderr.write('sampling: ' + str(sbc.estimate_stats) + '\n')
+    else:
+        print(sbc.compute())
+    sys.stderr.write('compressed sizes cache: ' + str(sbc.cache.stats()) + '\n')
 
 
 ########
@@ -20,6 +20,14 @@ def read_from_file(file_name, separator=" ", reverse=False):
 
     lst = []
     alphabet = set()
+    for a in iter_sequences(file_name, separator=separator, reverse=reverse):
+        lst.append(a)
+        alphabet.update(a)
+    return lst, list(alphabet)
+
+
+# reads sequences from file one at a time (buffered), as read_from_file
+def iter_sequences(file_name, separator=" ", reverse=False):
     with open(file_name) as fp:
         for line in fp:
             if separator == "":
@@ -29,9 +37,7 @@ def read_from_file(file_name, separator=" ", reverse=False):
             if a:
                 if reverse:
                     a.reverse()
-                lst.append(a)
-                alphabet.update(a)
-    return lst, list(alphabet)
+                yield a
 
 
 def dict_to_arr(d):